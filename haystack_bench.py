@@ -0,0 +1,170 @@
+import argparse
+import contextlib
+import os
+import time
+import numpy as np
+from haystack_index import FeatureIndex
+from haystack_cache import HaystackCache, ADMISSION_POLICIES
+from haystack_ring import HashRing
+
+
+def synthetic_features(num, dim=64, clusters=100, seed=0):
+    # Embeddings cluster by class, so sample around random class centres
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 1, (clusters, dim)).astype('float32')
+    labels = rng.integers(0, clusters, num)
+    return centres[labels] + rng.normal(0, 0.3, (num, dim)).astype('float32')
+
+
+def bench_index(args):
+    data = synthetic_features(args.num_vectors + args.num_queries, seed=args.seed)
+    corpus = data[:args.num_vectors]
+    queries = data[args.num_vectors:]
+    ids = np.arange(args.num_vectors, dtype='int64')
+
+    def population():
+        return ids, corpus
+
+    exact = FeatureIndex(64, 'flat', population=population)
+    exact.add(ids, corpus)
+    _, truth = exact.search(queries, k=1)
+
+    configs = [('flat', 'exact', {})]
+    for nprobe in (1, 4, 16, 64):
+        configs.append(('ivf', f"nprobe={nprobe}", {'nlist': args.nlist, 'nprobe': nprobe}))
+    for nprobe in (4, 16, 64):
+        configs.append(('ivfpq', f"nprobe={nprobe}", {'nlist': args.nlist, 'nprobe': nprobe, 'pq_m': 16}))
+    for ef_search in (16, 32, 64, 128):
+        configs.append(('hnsw', f"efSearch={ef_search}", {'ef_search': ef_search}))
+
+    print(f"{args.num_vectors} vectors, {args.num_queries} single-vector queries")
+    print(f"{'backend':<8} {'setting':<14} {'build s':>8} {'recall@1':>9} {'mean ms':>8} {'p99 ms':>8}")
+
+    for index_type, setting, options in configs:
+        index = FeatureIndex(64, index_type, population=population, **options)
+        start = time.perf_counter()
+        index.rebuild()
+        build = time.perf_counter() - start
+
+        found = np.empty(len(queries), dtype='int64')
+        latencies = np.empty(len(queries))
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            _, labels = index.search(query, k=1)
+            latencies[i] = time.perf_counter() - start
+            found[i] = labels[0][0]
+
+        recall = float(np.mean(found == truth[:, 0]))
+        print(f"{index_type:<8} {setting:<14} {build:>8.2f} {recall:>9.3f} "
+              f"{latencies.mean() * 1000:>8.3f} {np.percentile(latencies, 99) * 1000:>8.3f}")
+
+
+def zipf_trace(num_keys, length, skew, rng):
+    weights = 1 / np.arange(1, num_keys + 1) ** skew
+    return rng.choice(num_keys, size=length, p=weights / weights.sum())
+
+
+def bench_cache(args):
+    rng = np.random.default_rng(args.seed)
+    trace = zipf_trace(args.num_keys, args.num_requests, args.skew, rng).tolist()
+
+    # Interleave sequential scans of keys that are read exactly once, like a re-index job
+    keys = []
+    next_scan_key = args.num_keys
+    for i, key in enumerate(trace):
+        keys.append((str(key), False))
+        if args.scan_every and (i + 1) % args.scan_every == 0:
+            for _ in range(args.scan_length):
+                keys.append((str(next_scan_key), True))
+                next_scan_key += 1
+
+    photo = bytes(args.photo_bytes)
+    entry_size = HaystackCache(compression='none').entry_size(str(next_scan_key), photo)
+
+    print(f"{args.num_requests} Zipf(s={args.skew}) reads over {args.num_keys} photos, "
+          f"{next_scan_key - args.num_keys} one-off scan reads")
+    print(f"{'entries':>8} {'policy':<8} {'hit ratio':>10} {'zipf hit ratio':>15}")
+
+    for cache_entries in args.cache_entries:
+        for admission in ADMISSION_POLICIES:
+            cache = HaystackCache(cache_entries * entry_size, admission, compression='none')
+            hits = 0
+            zipf_hits = 0
+
+            # Same sequence of calls the /read route makes, with its logging silenced
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for key, is_scan in keys:
+                    if cache.get_photo(key) is not None:
+                        hits += 1
+                        zipf_hits += not is_scan
+                    else:
+                        cache.add_photo(key, photo)
+
+            print(f"{cache_entries:>8} {admission:<8} {hits / len(keys):>10.3f} {zipf_hits / len(trace):>15.3f}")
+
+
+def bench_ring(args):
+    keys = range(args.num_keys)
+    nodes = [str(i) for i in range(args.num_nodes)]
+    grown = nodes + [str(args.num_nodes)]
+    ideal = 1 / len(grown)
+
+    print(f"{args.num_keys} photo ids, {args.num_nodes} -> {len(grown)} cache servers, "
+          f"ideal movement {ideal:.3f}")
+    print(f"{'scheme':<16} {'moved':>8} {'max/mean load':>14}")
+
+    before = [key % len(nodes) for key in keys]
+    after = [key % len(grown) for key in keys]
+    moved = sum(a != b for a, b in zip(before, after)) / args.num_keys
+    print(f"{'modulo':<16} {moved:>8.3f} {1.0:>14.3f}")
+
+    for vnodes in args.vnodes:
+        ring = HashRing({node: 1.0 for node in nodes}, vnodes)
+        before = [ring.get_node(key) for key in keys]
+        ring.add_node(grown[-1])
+        after = [ring.get_node(key) for key in keys]
+        moved = sum(a != b for a, b in zip(before, after)) / args.num_keys
+
+        loads = np.unique(after, return_counts=True)[1]
+        print(f"{'ring vnodes=' + str(vnodes):<16} {moved:>8.3f} {loads.max() / loads.mean():>14.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Haystack services.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    index_parser = subparsers.add_parser("index", help="Recall vs latency of the directory's nearest neighbour backends")
+    index_parser.add_argument("--num-vectors", type=int, default=200000, help="Corpus size")
+    index_parser.add_argument("--num-queries", type=int, default=1000, help="Number of queries")
+    index_parser.add_argument("--nlist", type=int, default=1024, help="IVF cells")
+    index_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    cache_parser = subparsers.add_parser("cache", help="Hit ratio of the cache admission policies on a Zipfian trace with scans")
+    cache_parser.add_argument("--num-keys", type=int, default=100000, help="Distinct photos in the Zipfian part of the trace")
+    cache_parser.add_argument("--num-requests", type=int, default=500000, help="Zipfian reads")
+    cache_parser.add_argument("--skew", type=float, default=0.9, help="Zipf exponent")
+    cache_parser.add_argument("--scan-every", type=int, default=50000, help="Zipfian reads between scans, 0 disables scans")
+    cache_parser.add_argument("--scan-length", type=int, default=20000, help="Photos read by each scan")
+    cache_parser.add_argument("--photo-bytes", type=int, default=32 * 1024, help="Size of every cached photo")
+    cache_parser.add_argument("--cache-entries", type=int, nargs="+", default=[1000, 5000, 20000], help="Cache sizes to compare, in photos")
+    cache_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    ring_parser = subparsers.add_parser("ring", help="Keys remapped when a cache server joins, modulo vs consistent hashing")
+    ring_parser.add_argument("--num-keys", type=int, default=200000, help="Photo ids to place")
+    ring_parser.add_argument("--num-nodes", type=int, default=3, help="Cache servers before the resize")
+    ring_parser.add_argument("--vnodes", type=int, nargs="+", default=[1, 10, 40, 160], help="Virtual node counts to compare")
+
+    args = parser.parse_args()
+
+    if args.command == "index":
+        bench_index(args)
+    elif args.command == "cache":
+        bench_cache(args)
+    elif args.command == "ring":
+        bench_ring(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
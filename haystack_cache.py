@@ -1,29 +1,302 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import  requests
 import random
 import argparse
+import sys
+import threading
+import zlib
 import concurrent.futures
+from collections import OrderedDict
+from haystack_codec import FRAMES_MIMETYPE, OCTET_STREAM, STREAM_CHUNK, frames_length, iter_frames, photo_mimetype, unpack_frames
+from haystack_http import HttpPool, DEFAULT_TIMEOUT
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 app = Flask(__name__)
 
-class HaystackCache:
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+ADMISSION_POLICIES = ['tinylfu', 'lru']
+
+# codec -> (compress, decompress), fastest available first, zlib is always there
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.compress(data, 3), zstandard.decompress)
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+COMPRESSION_CHOICES = ['auto', 'none'] + list(CODECS)
+
+# Formats that are already entropy coded, compressing them again only burns CPU
+COMPRESSED_MIMETYPES = {'image/jpeg', 'image/png', 'image/gif'}
+
+class FrequencySketch:
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x85EBCA77C2B2AE63)
+    HALVE = bytes(count >> 1 for count in range(256))
+
+    def __init__(self, width):
+        # 4-bit saturating counters in a count-min sketch, halved periodically so old popularity fades
+        width = 1 << max(4, (width - 1).bit_length())
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in self.SEEDS]
+        self.sample_size = width * 10
+        self.additions = 0
+
+    def indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [(((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 32) & self.mask for seed in self.SEEDS]
+
+    def increment(self, key):
+        for row, index in zip(self.rows, self.indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [row.translate(self.HALVE) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+class SingleFlight:
     def __init__(self):
-        self.cache = {}
+        self.calls = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.calls[key] = future
+            else:
+                self.coalesced += 1
+
+        # Concurrent callers for the same key wait for the first one's result
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def do_many(self, keys, fn):
+        # do for several distinct keys at once. fn gets the keys nobody else is fetching and returns
+        # {key: result}, every key comes back with its result or the exception its fetch raised
+        futures = {}
+        leading = []
+        with self.lock:
+            for key in keys:
+                future = self.calls.get(key)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    self.calls[key] = future
+                    leading.append(key)
+                else:
+                    self.coalesced += 1
+                futures[key] = future
+
+        if leading:
+            try:
+                results = fn(leading)
+                for key in leading:
+                    if key in results:
+                        futures[key].set_result(results[key])
+                    else:
+                        futures[key].set_exception(LookupError(f"Photo {key} could not be read from its store"))
+            except BaseException as e:
+                for key in leading:
+                    if not futures[key].done():
+                        futures[key].set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    for key in leading:
+                        del self.calls[key]
+
+        outcomes = {}
+        for key, future in futures.items():
+            try:
+                outcomes[key] = future.result()
+            except Exception as e:
+                outcomes[key] = e
+        return outcomes
+
+class HaystackCache:
+    def __init__(self, max_bytes=256 * 1024 ** 2, admission='tinylfu', compression='auto', max_photo_bytes=8 * 1024 ** 2):
+        # key -> (stored photo, accounted size, codec or None, photo length), least recently used first
+        self.cache = OrderedDict()
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.raw_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.lock = threading.Lock()
+
+        # TinyLFU: a miss only displaces photos that are requested less often than itself
+        self.sketch = None
+        if admission == 'tinylfu':
+            self.sketch = FrequencySketch(max(1024, max_bytes // 8192))
+
+        if compression == 'auto':
+            compression = next(iter(CODECS))
+        self.codec = None if compression == 'none' else compression
+
+        # Photos above max_photo_bytes are streamed through and never held in memory,
+        # the keys of recent ones are remembered so their reads go straight to the store
+        self.max_photo_bytes = max_photo_bytes
+        self.oversized = OrderedDict()
+        self.max_oversized = 10000
+        self.streamed = 0
+
+    def entry_size(self, key, data):
+        return sys.getsizeof(key) + sys.getsizeof(data)
+
+    def encode(self, data):
+        if self.codec is None or photo_mimetype(data) in COMPRESSED_MIMETYPES:
+            return data, None
+        compressed = CODECS[self.codec][0](data)
+        # Keep the photo as is unless compression saves at least a tenth of it
+        if len(compressed) > len(data) * 0.9:
+            return data, None
+        return compressed, self.codec
+
+    def decode(self, data, codec):
+        if codec is None:
+            return data
+        return CODECS[codec][1](data)
     
     def get_photo(self, key):
-        return self.cache.get(key, None)
+        with self.lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+
+            entry = self.cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+        return self.decode(entry[0], entry[2])
+
+    def is_oversized(self, key):
+        with self.lock:
+            if key not in self.oversized:
+                return False
+            self.oversized.move_to_end(key)
+            self.streamed += 1
+            return True
+
+    def mark_oversized(self, key):
+        with self.lock:
+            self.oversized[key] = True
+            self.oversized.move_to_end(key)
+            if len(self.oversized) > self.max_oversized:
+                self.oversized.popitem(last=False)
+            self.streamed += 1
 
     def add_photo(self, key, data):
-        self.cache[key] = data
+        stored, codec = self.encode(data)
+        size = self.entry_size(key, stored)
+        if size > self.max_bytes:
+            print(f"Photo with key {key} is larger than the cache, not added")
+            return
+
+        with self.lock:
+            if key in self.cache:
+                old = self.cache.pop(key)
+                self.current_bytes -= old[1]
+                self.raw_bytes -= old[3]
+            elif self.sketch is not None and self.current_bytes + size > self.max_bytes:
+                frequency = self.sketch.estimate(key)
+                freed = 0
+                for victim_key, (_, victim_size, _, _) in self.cache.items():
+                    if self.current_bytes - freed + size <= self.max_bytes:
+                        break
+                    if self.sketch.estimate(victim_key) >= frequency:
+                        self.rejections += 1
+                        return
+                    freed += victim_size
+
+            self.cache[key] = (stored, size, codec, len(data))
+            self.current_bytes += size
+            self.raw_bytes += len(data)
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.current_bytes -= evicted[1]
+                self.raw_bytes -= evicted[3]
+                self.evictions += 1
         print(f"Photo with key {key} added to cache")
 
     def remove_photo(self, key):
-        if key in self.cache:
-            del self.cache[key]
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+                self.raw_bytes -= entry[3]
+        if entry is not None:
             print(f"Photo with key {key} removed from cache")
         else:
             print(f"Photo with key {key} not found in cache")
 
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.cache),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'photo_bytes': self.raw_bytes,
+                'compression': self.codec or 'none',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'streamed': self.streamed
+            }
+
+def stream_from_store(machine_url, params):
+    response = http_pool.get(f"http://{machine_url}/get", params=params, stream=True)
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+
+    def body():
+        try:
+            yield from response.iter_content(STREAM_CHUNK)
+        finally:
+            response.close()
+
+    headers = {}
+    if 'Content-Length' in response.headers:
+        headers['Content-Length'] = response.headers['Content-Length']
+    return Response(body(), status=200, mimetype=response.headers.get('Content-Type', OCTET_STREAM), headers=headers)
+
 @app.route('/read', methods=['GET'])
 def get_photo():
     key = request.args.get('key')
@@ -32,25 +305,123 @@ def get_photo():
     
     photo = cache.get_photo(key)
     if photo:
-        return jsonify({'data': photo}), 200
+        return Response(photo, status=200, mimetype=photo_mimetype(photo))
     else:
         machine_url = request.args.get('machine_url')
         if not machine_url:
             return jsonify({"error": "need machine url to access machine"}), 400
         
-        try:
-            response = requests.get(f"http://{machine_url}/get", params=request.args)
-            data = response.json()
-            response.raise_for_status()
-            photo = data['data']
+        params = request.args.to_dict()
+
+        def fetch_from_store():
+            response = http_pool.get(f"http://{machine_url}/get", params=params, stream=True)
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length is None or int(length) > cache.max_photo_bytes:
+                # Too large to buffer, every waiting reader streams its own copy instead
+                response.close()
+                cache.mark_oversized(key)
+                return None
+            photo = response.content
 
             # Should add only if the photo is right enabled store
             cache.add_photo(key, photo)
+            return photo
+
+        try:
+            photo = None
+            if not cache.is_oversized(key):
+                photo = store_fetches.do(key, fetch_from_store)
+            if photo is None:
+                return stream_from_store(machine_url, params)
 
-            return jsonify({'data': photo}), 200
+            return Response(photo, status=200, mimetype=photo_mimetype(photo))
 
         except requests.RequestException as e:
             return jsonify({"error": str(e)}), 500
+        except LookupError as e:
+            # Coalesced onto a /read_many that did not find the photo
+            return jsonify({"error": str(e)}), 404
+
+@app.route('/read_many', methods=['GET'])
+def get_photos():
+    keys = [key for key in request.args.get('keys', '').split(',') if key]
+    physical_ids = [phy for phy in request.args.get('physical_ids', '').split(',') if phy]
+    machine_urls = [url for url in request.args.get('machine_urls', '').split(',') if url]
+
+    if not keys or len(physical_ids) != len(keys) or len(machine_urls) != len(keys):
+        return jsonify({"error": "keys, physical_ids and machine_urls must be comma separated lists of the same length"}), 400
+
+    photos = [cache.get_photo(key) for key in keys]
+
+    # Misses are coalesced per key with concurrent /read and /read_many calls,
+    # the keys this request leads are fetched with one /get_many per store
+    missing = {}
+    for i, photo in enumerate(photos):
+        if photo is None:
+            missing.setdefault(keys[i], i)
+
+    def fetch_many_from_store(machine_url, store_keys):
+        params = {
+            'keys': ','.join(store_keys),
+            'physical_ids': ','.join(physical_ids[missing[key]] for key in store_keys)
+        }
+        response = http_pool.get(f"http://{machine_url}/get_many", params=params)
+        response.raise_for_status()
+        return store_keys, unpack_frames(response.content)
+
+    def fetch_many(leading):
+        by_store = {}
+        for key in leading:
+            by_store.setdefault(machine_urls[missing[key]], []).append(key)
+
+        fetched = {}
+        futures = [store_executor.submit(fetch_many_from_store, url, store_keys) for url, store_keys in by_store.items()]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                store_keys, frames = future.result()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Error while reading photos from store: {str(e)}")
+                continue
+
+            for key, photo in zip(store_keys, frames):
+                if not photo:
+                    continue
+                # Same size cap as /read, large photos are passed on but never cached
+                if len(photo) > cache.max_photo_bytes:
+                    cache.mark_oversized(key)
+                else:
+                    cache.add_photo(key, photo)
+                fetched[key] = photo
+        return fetched
+
+    if missing:
+        outcomes = store_fetches.do_many(list(missing), fetch_many)
+
+        # A /read leader hands back None for a photo too large to buffer, read those here
+        again = [key for key, outcome in outcomes.items() if outcome is None]
+        if again:
+            outcomes.update(fetch_many(again))
+
+        for i, photo in enumerate(photos):
+            if photo is None:
+                outcome = outcomes[keys[i]]
+                if isinstance(outcome, bytes):
+                    photos[i] = outcome
+
+    # Same framing as the store, an empty frame for a photo that could not be read
+    frames = [photo or b'' for photo in photos]
+    headers = {'Content-Length': str(frames_length(frames))}
+    return Response(iter_frames(frames), status=200, mimetype=FRAMES_MIMETYPE, headers=headers)
+
+@app.route('/stats', methods=['GET'])
+def cache_stats():
+    stats = cache.stats()
+    stats['coalesced_misses'] = store_fetches.coalesced
+    stats['http'] = http_pool.stats()
+    return jsonify(stats), 200
 
 @app.route('/remove', methods=['DELETE'])
 def remove_photo():
@@ -72,21 +443,20 @@ def remove_photo():
 
     def send_delete_request(url, physical_id):
         try:
-            response = requests.delete(f"http://{url}/remove", params={"key": key, "physical_id": physical_id, 'logical_id': logical_id})
+            response = http_pool.delete(f"http://{url}/remove", params={"key": key, "physical_id": physical_id, 'logical_id': logical_id})
             response.raise_for_status()
             return {"url": url, "status": "success"}
         except requests.RequestException as e:
             return {"url": url, "status": "error", "error": str(e)}
 
     results = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for url, physical_id in zip(machine_urls, physical_ids):
-            futures.append(executor.submit(send_delete_request, url, physical_id))
+    futures = []
+    for url, physical_id in zip(machine_urls, physical_ids):
+        futures.append(store_executor.submit(send_delete_request, url, physical_id))
 
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results.append(result)
+    for future in concurrent.futures.as_completed(futures):
+        result = future.result()
+        results.append(result)
 
     errors = [result for result in results if result["status"] == "error"]
     if len(errors):
@@ -96,11 +466,25 @@ def remove_photo():
 
     
 if __name__ == '__main__':
-    cache = HaystackCache()
     parser = argparse.ArgumentParser(description='Run the Flask web server.')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the web server on')
+    parser.add_argument('--max-bytes', type=parse_size, default='256MB', help='Memory budget for cached photos, e.g. 512MB or 2G')
+    parser.add_argument('--admission', choices=ADMISSION_POLICIES, default='tinylfu', help='Admission policy applied on a miss when the cache is full')
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default='auto', help='Codec for photos that are not already compressed, auto picks the fastest installed one')
+    parser.add_argument('--pool-size', type=int, default=32, help='Keep-alive connections kept per store')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_TIMEOUT[0], help='Seconds to connect to a store')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_TIMEOUT[1], help='Seconds to wait for a store response')
+    parser.add_argument('--max-photo-bytes', type=parse_size, default='8MB', help='Larger photos are streamed from the store without being cached')
     args = parser.parse_args()
-    
+
+    cache = HaystackCache(args.max_bytes, args.admission, args.compression, args.max_photo_bytes)
+    store_fetches = SingleFlight()
+    http_pool = HttpPool(args.pool_size, (args.connect_timeout, args.read_timeout))
+    # Shared by every request that fans out to several stores
+    store_executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.pool_size)
+
+    # werkzeug's dev server closes every connection, keep-alive from the webserver needs a WSGI
+    # server that supports it, e.g. gunicorn --threads 32 "haystack_cache:app" with the setup above
     app.run(port=args.port)
 
 
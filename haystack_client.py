@@ -4,10 +4,14 @@ import json
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
-import numpy as np
 import math
 import os
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+import io
+from haystack_codec import FRAMES_MIMETYPE, OCTET_STREAM, pack_frames, unpack_frames
+from haystack_http import HttpPool
+
+# The interactive loop sends every command over the same keep-alive connection
+http_pool = HttpPool(pool_size=4)
 
 def client_write20():
     results = []
@@ -24,20 +28,18 @@ def client_write20():
         print(result)
     return {"results": "results"}
 
+def read_image_file(file_path):
+    with open(file_path, 'rb') as file:
+        photo_bytes = file.read()
+
+    # Resizing and preprocessing happen server side, only check that this is an image
+    Image.open(io.BytesIO(photo_bytes)).verify()
+    return photo_bytes
+
 def client_write(file_path):
     try:
-        with open(file_path, 'rb') as file:
-            image = Image.open(file).convert('RGB') 
-            image = image.resize((224, 224))  
-            image_array = np.array(image)
-            
-            if image_array.shape != (224, 224, 3):
-                return {"error": f"Invalid image shape: {image_array.shape}"}
-            
-            preprocessed_image = preprocess_input(image_array)
-            
-            image_list = preprocessed_image.tolist()
-        response = requests.post("http://localhost:8000/write", json={'photo_data': image_list})
+        photo_bytes = read_image_file(file_path)
+        response = http_pool.post("http://localhost:8000/write", data=photo_bytes, headers={'Content-Type': OCTET_STREAM})
         response.raise_for_status()
         return response.json()
     except FileNotFoundError:
@@ -48,30 +50,20 @@ def client_write(file_path):
         return {"error": f"Unexpected error: {e}"}
 
 def client_write_batch(image_paths):
-    if len(image_paths) != 16:
-        return {"error": "Exactly 16 image paths are required."}
+    if len(image_paths) == 0:
+        return {"error": "At least one image path is required."}
 
     images_data = []
     for file_path in image_paths:
         try:
-            with open(file_path, 'rb') as file:
-                image = Image.open(file).convert('RGB')
-                image = image.resize((224, 224))
-                image_array = np.array(image)
-
-                if image_array.shape != (224, 224, 3):
-                    return {"error": f"Invalid image shape: {image_array.shape}"}
-
-                preprocessed_image = preprocess_input(image_array)
-                image_list = preprocessed_image.tolist()
-                images_data.append(image_list)
+            images_data.append(read_image_file(file_path))
         except FileNotFoundError:
             return {"error": f"File not found: {file_path}"}
         except Exception as e:
             return {"error": f"Unexpected error: {e}"}
 
     try:
-        response = requests.post("http://localhost:8000/write_batch", json={'photo_data': images_data})
+        response = http_pool.post("http://localhost:8000/write_batch", data=pack_frames(images_data), headers={'Content-Type': FRAMES_MIMETYPE})
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
@@ -79,19 +71,10 @@ def client_write_batch(image_paths):
 
 def client_read(id):
     try:
-        response = requests.get(f"http://localhost:8000/read", params={'photo_id': id})
+        response = http_pool.get(f"http://localhost:8000/read", params={'photo_id': id})
         response.raise_for_status()
-        data = response.json()
-        data = np.array(data)
-        
-        # Normalize data from [-1, 1] to [0, 1]
-        data = (data + 1) / 2
-        
-        # Ensure data is in the correct range
-        data = np.clip(data, 0, 1)
-
-        # Convert back to image
-        image = Image.fromarray((data * 255).astype(np.uint8))
+
+        image = Image.open(io.BytesIO(response.content)).convert('RGB')
         display_image_with_matplotlib(image)
         return {"status": "success", "message": "Image printed successfully"}
 
@@ -100,20 +83,13 @@ def client_read(id):
 
 def client_read_sim(photo_id, num_of_similar, num_cols=5):
     try:
-        response = requests.get(f"http://localhost:8000/read_similar", params={'photo_id': photo_id, 'num_of_similar': num_of_similar})
+        response = http_pool.get(f"http://localhost:8000/read_similar", params={'photo_id': photo_id, 'num_of_similar': num_of_similar})
         response.raise_for_status()
-        data = response.json()
-        actual_img = data['actual']
-        similar_imgs = data['similar']
-
-        actual_img = np.array(actual_img)
-        actual_img = (actual_img + 1) / 2
-        
-        # Ensure data is in the correct range
-        actual_img = np.clip(actual_img, 0, 1)
+        frames = unpack_frames(response.content)
+        actual_img = frames[0]
+        similar_imgs = frames[1:]
 
-        # Convert back to image
-        original_image = Image.fromarray((actual_img * 255).astype(np.uint8))
+        original_image = Image.open(io.BytesIO(actual_img)).convert('RGB')
 
         # Calculate the number of rows needed
         num_rows = math.ceil((len(similar_imgs) + 1) / num_cols)
@@ -130,10 +106,7 @@ def client_read_sim(photo_id, num_of_similar, num_cols=5):
 
         # Plot the similar images
         for i, sim_img in enumerate(similar_imgs):
-            sim_img = np.array(sim_img)
-            sim_img = (sim_img + 1) / 2
-            sim_img = np.clip(sim_img, 0, 1)
-            similar = Image.fromarray((sim_img * 255).astype(np.uint8))
+            similar = Image.open(io.BytesIO(sim_img)).convert('RGB')
             axes[i + 1].imshow(similar)
             axes[i + 1].set_title(f'Similar Image {i + 1}')
             axes[i + 1].axis('off')
@@ -158,12 +131,20 @@ def display_image_with_matplotlib(image):
 
 def client_delete(id):
     try:
-        response = requests.delete(f"http://localhost:8000/delete", params={'photo_id': id})
+        response = http_pool.delete(f"http://localhost:8000/delete", params={'photo_id': id})
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
         return {"error": str(e)}
 
+def client_http_stats():
+    try:
+        response = http_pool.get("http://localhost:8000/http_stats")
+        response.raise_for_status()
+        return {"client": http_pool.stats(), "webserver": response.json()}
+    except requests.RequestException as e:
+        return {"error": str(e)}
+
 def main():
     parser = argparse.ArgumentParser(description="Client for interacting with the server.")
     subparsers = parser.add_subparsers(dest="command")
@@ -179,14 +160,16 @@ def main():
 
     read_sim_parser = subparsers.add_parser("read_sim", help="Read data from the server")
     read_sim_parser.add_argument("photo_id", type=int, help="ID of the data to read")
-    read_sim_parser.add_argument("num_of_similar", type=list, help="Data to write")
+    read_sim_parser.add_argument("num_of_similar", type=int, help="Number of similar photos to show")
 
     write_batch_parser = subparsers.add_parser("write_batch", help="Write a batch of data to the server")
-    write_batch_parser.add_argument("image_paths", nargs=16, help="16 space-separated image paths")
+    write_batch_parser.add_argument("image_paths", nargs="+", help="Space-separated image paths")
 
 
     subparsers.add_parser("write20", help="Write the first element of all 20 classes in the dataset")
 
+    subparsers.add_parser("http_stats", help="Show connection reuse of this client and of the web server")
+
     while True:
         args = parser.parse_args(input("Enter command: ").split())
 
@@ -202,6 +185,8 @@ def main():
             result = client_write_batch(args.image_paths)
         elif args.command == "read_sim":
             result = client_read_sim(args.photo_id, args.num_of_similar)
+        elif args.command == "http_stats":
+            result = client_http_stats()
         else:
             parser.print_help()
             continue
@@ -0,0 +1,64 @@
+import struct
+
+OCTET_STREAM = 'application/octet-stream'
+FRAMES_MIMETYPE = 'application/x-haystack-frames'
+
+# Several photos in one body are sent as [u32 little-endian length][payload] frames
+FRAME_HEADER = struct.Struct('<I')
+
+# Photo bodies are streamed in chunks of this size instead of being copied whole
+STREAM_CHUNK = 64 * 1024
+
+
+def pack_frames(payloads):
+    parts = []
+    for payload in payloads:
+        parts.append(FRAME_HEADER.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def iter_frames(payloads):
+    # The bytes of pack_frames, produced a chunk at a time so the body is never copied whole
+    for payload in payloads:
+        yield FRAME_HEADER.pack(len(payload))
+        yield from iter_chunks(payload)
+
+
+def frames_length(payloads):
+    return sum(FRAME_HEADER.size + len(payload) for payload in payloads)
+
+
+def unpack_frames(data):
+    view = memoryview(data)
+    payloads = []
+    offset = 0
+    while offset < len(view):
+        if offset + FRAME_HEADER.size > len(view):
+            raise ValueError("Truncated frame header")
+        (size,) = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if offset + size > len(view):
+            raise ValueError("Truncated frame payload")
+        payloads.append(bytes(view[offset:offset + size]))
+        offset += size
+    return payloads
+
+
+def iter_chunks(data, size=STREAM_CHUNK):
+    view = memoryview(data)
+    for offset in range(0, len(view), size):
+        yield bytes(view[offset:offset + size])
+
+
+def photo_mimetype(data):
+    head = bytes(data[:8])
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    if head.startswith(b'BM'):
+        return 'image/bmp'
+    return OCTET_STREAM
@@ -1,16 +1,90 @@
 from flask import Flask, request, jsonify
 import random
 import numpy as np
-import faiss
 import os
+import io
 import argparse
 import json
+import queue
+import threading
+import time
+import concurrent.futures
+from PIL import Image
 from tensorflow.keras.models import load_model
+from haystack_codec import unpack_frames
+from haystack_index import FeatureIndex, FeatureStore, INDEX_TYPES
+from haystack_ring import HashRing, parse_nodes
 
 app = Flask(__name__)
 
+def preprocess_photo(photo_bytes):
+    try:
+        image = Image.open(io.BytesIO(photo_bytes)).convert('RGB')
+    except Exception as e:
+        raise ValueError(f"Invalid image: {e}")
+
+    image = image.resize((224, 224))
+    # Same scaling as mobilenet_v2.preprocess_input
+    return np.asarray(image, dtype='float32') / 127.5 - 1.0
+
+class InferenceBatcher:
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, photos):
+        future = concurrent.futures.Future()
+        self.queue.put((photos, future))
+        return future
+
+    def predict(self, photos):
+        return self.submit(photos).result()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            # Keep collecting requests until the batch is full or the oldest one waited long enough
+            while count < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            inputs = np.concatenate([photos for photos, _ in batch])
+            predictions = []
+            for start in range(0, len(inputs), self.max_batch_size):
+                predictions.append(np.asarray(self.model.predict_on_batch(inputs[start:start + self.max_batch_size])))
+            predictions = np.concatenate(predictions)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for photos, future in batch:
+            future.set_result(predictions[offset:offset + len(photos)])
+            offset += len(photos)
+
+
 class HaystackDirectory:
-    def __init__(self):
+    def __init__(self, index_type='flat', index_options=None, max_batch_size=32, max_wait_ms=5, cache_nodes=None, vnodes=160):
         self.logical_id_to_physical_id = {0: [], 1: [], 2: [], 3: [], 4: [], 5: [], 6: [], 7: [], 8: [], 9: [], 10: [], 11: [], 12: [], 13: [], 14: [], 15: [], 16: [], 17: [], 18: [], 19: []} 
 
         for i in range(40):
@@ -22,13 +96,20 @@ class HaystackDirectory:
             self.write_enabled_volumes_id.add(i) 
 
         self.photo_id_to_logical_volume_id = {}
-        self.photo_id_to_features = {}
+        self.feature_store = FeatureStore(64)
+        self.feature_index = FeatureIndex(64, index_type, population=self.feature_store.population, **(index_options or {}))
         self.physical_id_to_machine_id = {}
 
         for i in range(40):
             self.physical_id_to_machine_id[i] = (i%2)
 
+        # Photo ids are allocated by the webserver, this only tracks the next unused one
         self.photo_id_counter = 0
+        self.counter_lock = threading.Lock()
+        self.batcher = None
+
+        # Adding or removing a cache server only remaps the photos on its share of the ring
+        self.cache_ring = HashRing(cache_nodes or {'0': 1.0, '1': 1.0, '2': 1.0}, vnodes)
 
         model_filename = 'mobilenetv2_embeddings_model.h5'
         
@@ -39,6 +120,7 @@ class HaystackDirectory:
         if os.path.exists(model_path):
             try:
                 self.model = load_model(model_path)
+                self.batcher = InferenceBatcher(self.model, max_batch_size, max_wait_ms)
                 print(f"Model loaded from {model_path}")
             except Exception as e:
                 print(f"Failed to load model from {model_path}: {e}")
@@ -47,7 +129,11 @@ class HaystackDirectory:
         
 
     def hash_function(self, photo_id):
-        return int(photo_id) % 3
+        return self.cache_ring.get_node(int(photo_id))
+
+    def note_photo_ids(self, photo_id, count=1):
+        with self.counter_lock:
+            self.photo_id_counter = max(self.photo_id_counter, photo_id + count)
 
     def add_mapping(self, logical_id, physical_id):
         if logical_id not in self.logical_id_to_physical_id:
@@ -61,87 +147,76 @@ class HaystackDirectory:
             self.write_enabled_volumes.remove(logical_id)
             print(f"Volume {logical_id} marked as read-only")
 
-    def compute_features_for_photo(self, photo):
-        photo_array = np.array(photo)
-        photo_array = np.resize(photo_array, (1, 224, 224, 3))
-        try:
-            prediction = self.model.predict(photo_array)
-            print(f"Prediction done")
-        except Exception as e:
-            print(f"Error during prediction: {e}")
-        return prediction
-    
-    def compute_features_for_photo_batch(self, photos):
-        photo_array = np.array(photos)
-        photo_array = np.resize(photo_array, (16, 224, 224, 3))
+    def predict(self, photo_array):
+        if self.batcher is None:
+            raise RuntimeError("Embedding model is not loaded")
         try:
-            prediction = self.model.predict(photo_array)
+            # Split large uploads so other requests can share the batches in between
+            step = self.batcher.max_batch_size
+            futures = [self.batcher.submit(photo_array[start:start + step]) for start in range(0, len(photo_array), step)]
+            prediction = np.concatenate([future.result() for future in futures])
             print(f"Prediction done")
         except Exception as e:
             print(f"Error during prediction: {e}")
+            raise
         return prediction
 
-    def nearest_photos_features(self, photo_ids, feature):
-        features = []
-
-        for photo_id in photo_ids:
-            features.append(self.photo_id_to_features[photo_id])
-        features = np.array(features)
-        features = features.astype('float32')
-        features = features.reshape((len(features), 64))
-
-        index = faiss.IndexFlatL2(64)
-        index.add(features)
-
-        query_feature = np.array([feature], dtype='float32').reshape(1, 64)
-
-        distances, indices = index.search(query_feature, k=1)
-
-        near = photo_ids[indices[0][0]]
-        nearest_photos_feature=self.photo_id_to_features[near]
-        nearest_photos_id=near
-        
-        return nearest_photos_feature, nearest_photos_id
+    def compute_features_for_photo(self, photo):
+        photo_array = preprocess_photo(photo)[np.newaxis]
+        return self.predict(photo_array)
     
-    def nearest_photos_features_batch(self, photo_ids, feature):
-        features = []
-
-        for photo_id in photo_ids:
-            features.append(self.photo_id_to_features[photo_id])
-        features = np.array(features)
-        features = features.astype('float32')
-        features = features.reshape((len(features), 64))
-
-        index = faiss.IndexFlatL2(64)
-        index.add(features)
-
-        query_feature = np.array([feature], dtype='float32').reshape(16, 64)
-
-        distances, indices = index.search(query_feature, k=1)
-
-        nearest_photos_features = []
-        nearest_photos_ids = []
-
-        for i in range(16):
-            near = photo_ids[indices[i][0]]
-            nearest_photos_feature=self.photo_id_to_features[near]
-            nearest_photos_id=near
-
-            nearest_photos_features.append(nearest_photos_feature)
-            nearest_photos_ids.append(nearest_photos_id)
-        
-        return nearest_photos_features, nearest_photos_ids
+    def compute_features_for_photo_batch(self, photos):
+        photo_array = np.stack([preprocess_photo(photo) for photo in photos])
+        return self.predict(photo_array)
+
+    def set_features(self, photo_id, features):
+        replaced = photo_id in self.feature_store
+        if not self.feature_store.set(photo_id, features):
+            return
+
+        if replaced:
+            self.feature_index.remove(photo_id)
+        self.feature_index.add(photo_id, self.feature_store.get(photo_id))
+
+    def remove_features(self, photo_id):
+        if self.feature_store.remove(photo_id):
+            self.feature_index.remove(photo_id)
+
+    def search(self, features, k=10, shard=0, num_shards=1, exclude=()):
+        exclude = set(exclude)
+        distances, labels = self.feature_index.search(features, k + len(exclude), shard=(shard, num_shards))
+
+        results = []
+        for row_distances, row_labels in zip(distances.tolist(), labels.tolist()):
+            hits = [[distance, label] for distance, label in zip(row_distances, row_labels) if label >= 0 and label not in exclude]
+            results.append(hits[:k])
+        return results
     
-    def nearest_photos_features_batch_diff(self, photo_ids, feature):
-        nearest_photos_features = []
-        nearest_photos_ids = []
-
-        for i in range(16):
-            temp_1, temp_2 = self.nearest_photos_features(photo_ids[i], feature[i])
-            nearest_photos_features.append(temp_1)
-            nearest_photos_ids.append(temp_2)
-
-        return nearest_photos_features, nearest_photos_ids
+    def choose_logical_volume(self, candidate_ids):
+        candidate_ids = [id for id in candidate_ids if id is not None]
+
+        if len(candidate_ids)==0:
+            # Nothing to be near yet, spread the first photos over empty volumes
+            empty_keys = set(self.write_enabled_volumes_id)
+            empty_keys.difference_update(self.photo_id_to_logical_volume_id.values())
+            if len(empty_keys)==0:
+                empty_keys = self.write_enabled_volumes_id
+            return random.choice(list(empty_keys))
+
+        # Candidates arrive nearest first, follow the closest one that is on a writable volume
+        for id in candidate_ids:
+            logical_id = self.photo_id_to_logical_volume_id.get(id)
+            if logical_id in self.write_enabled_volumes_id:
+                return logical_id
+
+        return random.choice(list(self.write_enabled_volumes_id))
+
+    def volume_placement(self, logical_volume):
+        physical_ids = list(self.logical_id_to_physical_id[logical_volume])
+        machine_ids = []
+        for p_id in physical_ids:
+            machine_ids.append(self.physical_id_to_machine_id[p_id])
+        return physical_ids, machine_ids
 
     
 @app.route('/read', methods=['GET'])
@@ -162,6 +237,35 @@ def read_request():
     
     return jsonify({"logical_id": logical_id, "physical_id": physical_id, "cache_id": cache_id, "machine_id": machine_id})
 
+@app.route('/read_batch', methods=['POST'])
+def read_batch_request():
+    data = request.get_json()
+
+    if not isinstance(data, dict) or not isinstance(data.get('photo_ids'), list):
+        return jsonify({"error": "photo_ids are required"}), 400
+
+    # Same fields as /read for every photo that still exists, missing ones are left out
+    photos = []
+    for photo_id in data['photo_ids']:
+        photo_id = int(photo_id)
+        logical_id = directory.photo_id_to_logical_volume_id.get(photo_id)
+        if logical_id is None:
+            continue
+
+        physical_id = random.choice(directory.logical_id_to_physical_id[logical_id])
+        if physical_id not in directory.physical_id_to_machine_id:
+            continue
+
+        photos.append({
+            "photo_id": photo_id,
+            "logical_id": logical_id,
+            "physical_id": physical_id,
+            "cache_id": directory.hash_function(photo_id),
+            "machine_id": directory.physical_id_to_machine_id[physical_id]
+        })
+
+    return jsonify({"photos": photos}), 200
+
 @app.route('/delete', methods=['DELETE'])
 def delete_request():
     photo_id = int(request.args.get('photo_id'))
@@ -172,7 +276,7 @@ def delete_request():
     logical_id = directory.photo_id_to_logical_volume_id[photo_id]
 
     del directory.photo_id_to_logical_volume_id[photo_id]
-    del directory.photo_id_to_features[photo_id]
+    directory.remove_features(photo_id)
 
     physical_ids = directory.logical_id_to_physical_id[logical_id]
 
@@ -188,115 +292,120 @@ def delete_request():
 
     return jsonify({"logical_id": logical_id, "physical_ids": physical_ids, "cache_id": cache_id, "machine_ids": machine_ids})
 
+@app.route('/cache_nodes', methods=['GET'])
+def get_cache_nodes():
+    return jsonify({'nodes': directory.cache_ring.nodes(), 'vnodes': directory.cache_ring.vnodes}), 200
+
+@app.route('/cache_nodes', methods=['PUT'])
+def set_cache_nodes():
+    # The webserver pushes the full membership to every directory so they all pick the same owner
+    data = request.json
+    if not data or not isinstance(data.get('nodes'), dict) or not data['nodes']:
+        return jsonify({"error": "nodes must map cache ids to weights"}), 400
+
+    directory.cache_ring.set_nodes({str(node): float(weight) for node, weight in data['nodes'].items()})
+    return jsonify({'nodes': directory.cache_ring.nodes()}), 200
+
+@app.route('/next_photo_id', methods=['GET'])
+def next_photo_id():
+    return jsonify({'next_photo_id': directory.photo_id_counter}), 200
+
 @app.route('/get_features_along_other_details', methods=['POST'])
 def get_features_along_other_details():
     try:
-        data = request.json
-        photo_data = data['photo_data']
+        photo_data = request.get_data()
         if not photo_data:
             return jsonify({"error": "photo_data is required"}), 400
 
-        photo_features = directory.compute_features_for_photo(photo_data)
-        
-        photo_id = directory.photo_id_counter
-        directory.photo_id_counter += 1
+        try:
+            photo_id = int(request.args.get('photo_id'))
+        except (TypeError, ValueError):
+            return jsonify({"error": "photo_id allocated by the webserver is required"}), 400
 
-        list_of_photo_ids = list(directory.photo_id_to_features.keys())
+        photo_features = directory.compute_features_for_photo(photo_data)
+        directory.note_photo_ids(photo_id)
 
-        directory.photo_id_to_features[photo_id] = photo_features
+        directory.set_features(photo_id, photo_features)
 
         photo_features = photo_features.tolist()
 
         result = {
             'features': photo_features,
-            'list_of_photo_ids': list_of_photo_ids,
             'photo_id': photo_id
         }
 
         return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 @app.route('/get_features_along_other_details_batch', methods=['POST'])
 def get_features_along_other_details_batch():
     try:
-        data = request.json
-        photo_data = data['photo_data']
+        photo_data = unpack_frames(request.get_data())
         if not photo_data:
             return jsonify({"error": "photo_data is required"}), 400
 
-        photo_features = directory.compute_features_for_photo_batch(photo_data)
-        
-        photo_id = directory.photo_id_counter
-        directory.photo_id_counter += 16
+        try:
+            photo_id = int(request.args.get('photo_id'))
+        except (TypeError, ValueError):
+            return jsonify({"error": "photo_id allocated by the webserver is required"}), 400
 
-        list_of_photo_ids = list(directory.photo_id_to_features.keys())
+        photo_features = directory.compute_features_for_photo_batch(photo_data)
+        directory.note_photo_ids(photo_id, len(photo_features))
 
-        for i in range(16):
-            directory.photo_id_to_features[photo_id+i] = photo_features[i]
+        for i in range(len(photo_features)):
+            directory.set_features(photo_id+i, photo_features[i])
 
         photo_features = photo_features.tolist()
 
         result = {
             'features': photo_features,
-            'list_of_photo_ids': list_of_photo_ids,
             'photo_id': photo_id
         }
 
         return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/compute_nearest', methods=['POST'])
-def compute_nearest():
-    try:
-        data = request.get_json()
-
-        if not data:
-            return jsonify({"error": "other_data is required"}), 400
-
-        if isinstance(data, str):
-            data = json.loads(data)
-
-        if not isinstance(data, dict):
-            return jsonify({"error": "data must be a dictionary"}), 400
-        
-        directory.photo_id_to_features[data['actual_id']] = data['features']
+@app.route('/search', methods=['POST'])
+def search_request():
+    data = request.get_json()
 
-        nearest_photos_feature, nearest_photos_id = directory.nearest_photos_features(data['photo_ids'], data['features'])
+    if not isinstance(data, dict) or (data.get('features') is None and data.get('photo_id') is None):
+        return jsonify({"error": "features or photo_id are required"}), 400
 
-        result ={'nearest_photos_id': nearest_photos_id}
-        return jsonify(result), 200
-    
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    
-@app.route('/compute_nearest_batch', methods=['POST'])
-def compute_nearest_batch():
     try:
+        k = int(data.get('k', 10))
+        shard = int(data.get('shard', 0))
+        num_shards = int(data.get('num_shards', 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "k, shard and num_shards must be integers"}), 400
+
+    if k < 1 or num_shards < 1 or not 0 <= shard < num_shards:
+        return jsonify({"error": "need k >= 1 and 0 <= shard < num_shards"}), 400
+
+    features = data.get('features')
+    exclude = list(data.get('exclude', ()))
+    if features is None:
+        # Similar photos to one that is already indexed, which is not a result itself
+        photo_id = int(data['photo_id'])
+        features = directory.feature_store.get(photo_id)
+        if features is None:
+            return jsonify({"error": "photo_id not found"}), 404
+        exclude.append(photo_id)
 
-        data = request.get_json()
-
-        if not data:
-            return jsonify({"error": "other_data is required"}), 400
-
-        if isinstance(data, str):
-            data = json.loads(data)
-
-        if not isinstance(data, dict):
-            return jsonify({"error": "data must be a dictionary"}), 400
-
-        for i in range(16):
-            directory.photo_id_to_features[data['actual_id']+i] = data['features'][i]
-
-        nearest_photos_feature, nearest_photos_id = directory.nearest_photos_features_batch(data['photo_ids'], data['features'])
-
-        result ={'nearest_photos_id': nearest_photos_id}
-        return jsonify(result), 200
-    
+    try:
+        # One list of [distance, photo_id] per query vector, nearest first
+        results = directory.search(features, k, shard, num_shards, exclude)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    return jsonify({'results': results}), 200
+
 
 @app.route('/write_combined', methods=['POST'])
 def write_combined_request():
@@ -311,46 +420,13 @@ def write_combined_request():
     if not isinstance(data, dict):
         return jsonify({"error": "data must be a dictionary"}), 400
 
-    possible_ids = []
-
     print(data['nearest_photos_ids'])
 
-    flag=1
-
-    for id in data['nearest_photos_ids']:
-        if id is None:
-            flag=0
-        
-    if flag==1:    
-        for id in data['nearest_photos_ids']:
-            log_vol = directory.photo_id_to_logical_volume_id[id]
-
-            if log_vol in directory.write_enabled_volumes_id:
-                possible_ids.append(id)
-
-        if len(possible_ids)==0:
-            logical_volume = random.choice(list(directory.write_enabled_volumes_id))
-        else:
-            _, final_photo_id = directory.nearest_photos_features(possible_ids, data['features'])
-
-            logical_volume = directory.photo_id_to_logical_volume_id[final_photo_id]
-    else:
-        empty_keys = set(directory.write_enabled_volumes_id)
-        for id, value in directory.photo_id_to_logical_volume_id.items():
-            if value in empty_keys:
-                empty_keys.discard(value)
-
-        empty_keys = list(empty_keys)
-
-        logical_volume = random.choice(empty_keys)
+    logical_volume = directory.choose_logical_volume(data['nearest_photos_ids'])
 
     directory.photo_id_to_logical_volume_id[data['photo_id']] = logical_volume
 
-    machine_ids = []
-
-    physical_ids = list(directory.logical_id_to_physical_id[logical_volume])
-    for p_id in physical_ids:
-        machine_ids.append(directory.physical_id_to_machine_id[p_id])
+    physical_ids, machine_ids = directory.volume_placement(logical_volume)
 
     result = {
         'logical_id': logical_volume,
@@ -378,20 +454,12 @@ def write_combined_batch_request():
     machine_ids_ans = []
     logical_ids_ans = []
 
-    _, final_photo_id = directory.nearest_photos_features_batch_diff(data['nearest_photos_ids'], data['features'])
-
-    print(final_photo_id)
-
-    for i in range(16):
-        logical_volume = directory.photo_id_to_logical_volume_id[final_photo_id[i]]
+    for i in range(len(data['features'])):
+        logical_volume = directory.choose_logical_volume(data['nearest_photos_ids'][i])
         directory.photo_id_to_logical_volume_id[data['photo_id']+i] = logical_volume
         logical_ids_ans.append(logical_volume)
 
-        machine_ids = []
-
-        physical_ids = list(directory.logical_id_to_physical_id[logical_volume])
-        for p_id in physical_ids:
-            machine_ids.append(directory.physical_id_to_machine_id[p_id])
+        physical_ids, machine_ids = directory.volume_placement(logical_volume)
 
         physical_ids_ans.append(physical_ids)
         machine_ids_ans.append(machine_ids)
@@ -422,8 +490,8 @@ def update_volume():
     photo_id = data['photo_id']
 
     directory.photo_id_to_logical_volume_id[photo_id] = logical_id
-    directory.photo_id_to_features[photo_id] = data['features']
-    directory.photo_id_counter += 1
+    directory.set_features(photo_id, data['features'])
+    directory.note_photo_ids(photo_id)
 
     return jsonify({'message': 'Mapping added successfully'}), 200
 
@@ -443,21 +511,50 @@ def update_volume_batch():
     logical_id = data['logical_id']
     photo_id = data['photo_id']
 
-    for i in range(16):
+    for i in range(len(logical_id)):
         directory.photo_id_to_logical_volume_id[photo_id+i] = logical_id[i]
-        directory.photo_id_to_features[photo_id+i] = data['features'][i]
-        directory.photo_id_counter += 1
+        directory.set_features(photo_id+i, data['features'][i])
+    directory.note_photo_ids(photo_id, len(logical_id))
 
     return jsonify({'message': 'Mapping added successfully'}), 200
     
 
 if __name__ == '__main__':
-    directory = HaystackDirectory()
-
     parser = argparse.ArgumentParser(description='Run the Flask web server.')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the web server on')
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat', help='Nearest neighbour backend used for placement')
+    parser.add_argument('--nlist', type=int, default=256, help='Number of IVF cells (ivf, ivfpq)')
+    parser.add_argument('--nprobe', type=int, default=16, help='IVF cells visited per query (ivf, ivfpq)')
+    parser.add_argument('--pq-m', type=int, default=16, help='PQ sub-quantizers, must divide 64 (ivfpq)')
+    parser.add_argument('--hnsw-m', type=int, default=32, help='Graph neighbours per node (hnsw)')
+    parser.add_argument('--ef-search', type=int, default=64, help='Search queue size (hnsw)')
+    parser.add_argument('--retrain-factor', type=int, default=4, help='Retrain IVF once the population grows by this factor')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='Most photos embedded by one model call')
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='Longest a photo waits for its inference batch to fill')
+    parser.add_argument('--cache-nodes', nargs='+', default=['0', '1', '2'], help='Cache server ids on the hash ring until the webserver pushes its own, optionally weighted as id:weight')
+    parser.add_argument('--vnodes', type=int, default=160, help='Virtual nodes per cache server of weight 1')
     args = parser.parse_args()
-    
+
+    if args.nlist < 1 or args.nprobe < 1:
+        parser.error("--nlist and --nprobe must be positive")
+    if args.pq_m < 1 or 64 % args.pq_m:
+        parser.error("--pq-m must divide the 64 feature dimensions")
+    if args.retrain_factor <= 1:
+        parser.error("--retrain-factor must be above 1")
+
+    index_options = {
+        'nlist': args.nlist,
+        'nprobe': args.nprobe,
+        'pq_m': args.pq_m,
+        'hnsw_m': args.hnsw_m,
+        'ef_search': args.ef_search,
+        'retrain_factor': args.retrain_factor
+    }
+    directory = HaystackDirectory(args.index_type, index_options, args.max_batch_size, args.max_wait_ms,
+                                  parse_nodes(args.cache_nodes), args.vnodes)
+
+    # werkzeug's dev server closes every connection, keep-alive from the webserver needs a WSGI
+    # server that supports it, e.g. gunicorn --threads 32 with the setup above
     app.run(port=args.port)
 
 
@@ -0,0 +1,162 @@
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# (connect, read) seconds, reads are long enough for a batch of embeddings
+DEFAULT_TIMEOUT = (3.05, 60)
+
+
+class CountingAdapter(HTTPAdapter):
+    # urllib3 silently reconnects a connection the server closed, so its own connection
+    # counters miss most opens. Count every connect() of the pool's connections instead.
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.connects = 0
+        self.connects_lock = threading.Lock()
+
+        def counting(connection_cls):
+            adapter = self
+
+            class CountingConnection(connection_cls):
+                def connect(self):
+                    with adapter.connects_lock:
+                        adapter.connects += 1
+                    super().connect()
+            return CountingConnection
+
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            pool_classes[scheme] = type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': counting(pool_cls.ConnectionCls)})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+
+class HttpPool:
+    def __init__(self, pool_size=32, timeout=DEFAULT_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # host:port -> keep-alive session
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        session = self.sessions.get(host)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    # One pool per host, sized for the fan-outs of a busy webserver. Connections are only
+                    # reused if the host keeps them alive, werkzeug's dev server closes every one
+                    adapter = CountingAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self.sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self.lock:
+            self.requests += 1
+        try:
+            return self.session(url).request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def stats(self):
+        hosts = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+            total = {'requests': self.requests, 'errors': self.errors}
+        opened = 0
+        reused = 0
+        for host, session in sessions:
+            adapter = session.get_adapter('http://' + host)
+            host_requests = 0
+            host_connections = adapter.connects
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    host_requests += pool.num_requests
+            opened += host_connections
+            reused += max(0, host_requests - host_connections)
+            hosts[host] = {'requests': host_requests, 'connections_opened': host_connections}
+        total['connections_opened'] = opened
+        total['reused'] = reused
+        total['hosts'] = hosts
+        return total
+
+
+class AsyncHttpPool:
+    def __init__(self, pool_size=32, timeout=DEFAULT_TIMEOUT, max_connections=1000):
+        if httpx is None:
+            raise RuntimeError("httpx is required for the async pool")
+        # Every coroutine shares one client, pool_size idle connections are kept across all hosts together
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+        self.pool_size = pool_size
+        self.requests = 0
+        self.errors = 0
+        self.connections_opened = 0
+
+    async def trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+
+    async def request(self, method, url, **kwargs):
+        kwargs.setdefault('extensions', {'trace': self.trace})
+        self.requests += 1
+        try:
+            return await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    async def stream(self, method, url, **kwargs):
+        # The body is left unread, the caller must aclose() the response once it is consumed
+        kwargs.setdefault('extensions', {'trace': self.trace})
+        self.requests += 1
+        try:
+            return await self.client.send(self.client.build_request(method, url, **kwargs), stream=True)
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'connections_opened': self.connections_opened,
+            'reused': max(0, self.requests - self.errors - self.connections_opened)
+        }
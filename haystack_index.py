@@ -0,0 +1,327 @@
+import threading
+import time
+import numpy as np
+import faiss
+
+INDEX_TYPES = ['flat', 'ivf', 'ivfpq', 'hnsw']
+
+
+class FeatureStore:
+    def __init__(self, dim=64, capacity=1024):
+        self.dim = dim
+        self.matrix = np.empty((capacity, dim), dtype='float32')
+        # Photo id stored in each row, -1 marks a deleted row
+        self.row_ids = np.full(capacity, -1, dtype='int64')
+        self.id_to_row = {}
+        self.size = 0
+        self.deleted = 0
+        self.lock = threading.Lock()
+
+    def grow(self):
+        capacity = len(self.matrix) * 2
+        matrix = np.empty((capacity, self.dim), dtype='float32')
+        matrix[:self.size] = self.matrix[:self.size]
+        row_ids = np.full(capacity, -1, dtype='int64')
+        row_ids[:self.size] = self.row_ids[:self.size]
+        self.matrix = matrix
+        self.row_ids = row_ids
+
+    def compact(self):
+        live = self.row_ids[:self.size] >= 0
+        count = int(live.sum())
+        capacity = max(1024, len(self.matrix))
+        while capacity // 2 >= 1024 and capacity // 2 >= count * 2:
+            capacity //= 2
+
+        matrix = np.empty((capacity, self.dim), dtype='float32')
+        matrix[:count] = self.matrix[:self.size][live]
+        row_ids = np.full(capacity, -1, dtype='int64')
+        row_ids[:count] = self.row_ids[:self.size][live]
+
+        self.matrix = matrix
+        self.row_ids = row_ids
+        self.id_to_row = {photo_id: row for row, photo_id in enumerate(row_ids[:count].tolist())}
+        self.size = count
+        self.deleted = 0
+
+    def set(self, photo_id, features):
+        vector = np.asarray(features, dtype='float32').reshape(self.dim)
+        with self.lock:
+            row = self.id_to_row.get(photo_id)
+            if row is not None:
+                if np.array_equal(self.matrix[row], vector):
+                    return False
+                self.matrix[row] = vector
+                return True
+
+            if self.size == len(self.matrix):
+                self.grow()
+            row = self.size
+            self.size += 1
+            self.matrix[row] = vector
+            self.row_ids[row] = photo_id
+            self.id_to_row[photo_id] = row
+            return True
+
+    def get(self, photo_id):
+        row = self.id_to_row.get(photo_id)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def remove(self, photo_id):
+        with self.lock:
+            row = self.id_to_row.pop(photo_id, None)
+            if row is None:
+                return False
+            self.row_ids[row] = -1
+            self.deleted += 1
+            if self.deleted > max(1024, self.size // 4):
+                self.compact()
+            return True
+
+    def population(self):
+        with self.lock:
+            row_ids = self.row_ids[:self.size]
+            if not self.deleted:
+                return row_ids.copy(), self.matrix[:self.size].copy()
+            live = row_ids >= 0
+            return row_ids[live], self.matrix[:self.size][live]
+
+    def __contains__(self, photo_id):
+        return photo_id in self.id_to_row
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+
+class FeatureIndex:
+    def __init__(self, dim=64, index_type='flat', population=None, nlist=256, nprobe=16, pq_m=16,
+                 hnsw_m=32, ef_search=64, retrain_factor=4, retry_delay=60):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type}")
+        if nlist < 1 or nprobe < 1:
+            raise ValueError("nlist and nprobe must be positive")
+        if pq_m < 1 or dim % pq_m:
+            raise ValueError(f"pq_m must divide the {dim} feature dimensions")
+        if retrain_factor <= 1:
+            # Otherwise every add after a retrain would start the next one
+            raise ValueError("retrain_factor must be above 1")
+
+        self.dim = dim
+        self.index_type = index_type
+        # Callable returning (ids, features) for every live photo, used to (re)train
+        self.population = population
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.retrain_factor = retrain_factor
+
+        self.lock = threading.Lock()
+        # Updates made while a rebuild trains, replayed onto the new index before it is swapped in
+        self.pending = None
+        self.trained_size = 0
+
+        # Rebuilds run one at a time, a failed one is retried only after retry_delay seconds
+        self.rebuild_lock = threading.Lock()
+        self.retry_delay = retry_delay
+        self.retry_at = 0
+
+        # HNSW cannot remove vectors, deleted ids are filtered out at search time
+        self.tombstones = set()
+        self.tombstone_ids = None
+        self.stale = 0
+
+        # (shard, num_shards) -> bitmap of the ids in that shard, see shard_selector
+        self.max_id = -1
+        self.shard_bitmaps = {}
+
+        if index_type in ('ivf', 'ivfpq'):
+            # IVF needs a populated training set, search exactly until there is one
+            self.index = faiss.IndexIDMap(faiss.IndexFlatL2(dim))
+            self.trained = False
+        else:
+            self.index = self.build_index()
+            self.trained = True
+
+    def as_matrix(self, features):
+        return np.ascontiguousarray(np.asarray(features, dtype='float32').reshape(-1, self.dim))
+
+    def build_index(self):
+        if self.index_type == 'ivf':
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(self.dim), self.dim, self.nlist)
+            index.nprobe = self.nprobe
+            return index
+        if self.index_type == 'ivfpq':
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(self.dim), self.dim, self.nlist, self.pq_m, 8)
+            index.nprobe = self.nprobe
+            return index
+        if self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.dim, self.hnsw_m)
+            index.hnsw.efSearch = self.ef_search
+            return faiss.IndexIDMap(index)
+        return faiss.IndexIDMap(faiss.IndexFlatL2(self.dim))
+
+    def min_training_size(self):
+        # The PQ codebooks have 256 centroids each and need at least that many points
+        if self.index_type == 'ivfpq':
+            return max(self.nlist * 39, 256)
+        return self.nlist * 39
+
+    def needs_rebuild(self):
+        total = self.index.ntotal
+        if self.index_type in ('ivf', 'ivfpq'):
+            if not self.trained:
+                return total >= self.min_training_size()
+            return total >= self.retrain_factor * self.trained_size
+        if self.index_type == 'hnsw':
+            return len(self.tombstones) + self.stale > max(1000, total // 10)
+        return False
+
+    def maybe_rebuild(self):
+        if self.population is None:
+            return
+        with self.lock:
+            if self.pending is not None or time.monotonic() < self.retry_at or not self.needs_rebuild():
+                return
+            self.pending = []
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    def rebuild(self):
+        # A caller arriving during a rebuild waits for it, then rebuilds from the newer population
+        with self.rebuild_lock:
+            try:
+                self.build_and_swap()
+            except Exception as e:
+                # Keep serving the current index and stop queueing updates for the failed one
+                with self.lock:
+                    self.pending = None
+                    self.retry_at = time.monotonic() + self.retry_delay
+                print(f"Rebuilding {self.index_type} index failed: {str(e)}")
+
+    def build_and_swap(self):
+        with self.lock:
+            if self.pending is None:
+                self.pending = []
+            ids, vectors = self.population()
+        ids = np.asarray(ids, dtype='int64')
+        vectors = self.as_matrix(vectors)
+
+        index = self.build_index()
+        if not index.is_trained:
+            sample = vectors
+            limit = self.nlist * 256
+            if len(sample) > limit:
+                sample = vectors[np.random.choice(len(vectors), limit, replace=False)]
+            index.train(sample)
+        index.add_with_ids(vectors, ids)
+        tombstones = set()
+
+        with self.lock:
+            # Replay whatever changed while the new index was being trained
+            for op, op_ids, op_vectors in self.pending:
+                if op == 'add':
+                    fresh = ~np.isin(op_ids, ids)
+                    if fresh.any():
+                        index.add_with_ids(op_vectors[fresh], op_ids[fresh])
+                    tombstones.difference_update(op_ids.tolist())
+                elif self.index_type == 'hnsw':
+                    tombstones.update(op_ids.tolist())
+                else:
+                    index.remove_ids(op_ids)
+
+            self.index = index
+            self.trained = True
+            self.trained_size = index.ntotal
+            self.tombstones = tombstones
+            self.tombstone_ids = None
+            self.stale = 0
+            self.pending = None
+
+        print(f"Rebuilt {self.index_type} index with {index.ntotal} vectors")
+
+    def add(self, photo_ids, features):
+        ids = np.asarray(photo_ids, dtype='int64').reshape(-1)
+        vectors = self.as_matrix(features)
+        with self.lock:
+            if len(ids):
+                self.max_id = max(self.max_id, int(ids.max()))
+            if self.index_type == 'hnsw':
+                revived = self.tombstones.intersection(ids.tolist())
+                if revived:
+                    # The old vector stays in the graph until the next rebuild
+                    self.tombstones.difference_update(revived)
+                    self.tombstone_ids = None
+                    self.stale += len(revived)
+            self.index.add_with_ids(vectors, ids)
+            if self.pending is not None:
+                self.pending.append(('add', ids, vectors))
+        self.maybe_rebuild()
+
+    def remove(self, photo_ids):
+        ids = np.asarray(photo_ids, dtype='int64').reshape(-1)
+        with self.lock:
+            if self.index_type == 'hnsw':
+                self.tombstones.update(ids.tolist())
+                self.tombstone_ids = None
+                removed = len(ids)
+            else:
+                removed = self.index.remove_ids(ids)
+            if self.pending is not None:
+                self.pending.append(('remove', ids, None))
+        self.maybe_rebuild()
+        return removed
+
+    def search_params(self):
+        if self.trained and self.index_type in ('ivf', 'ivfpq'):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = self.ef_search
+        else:
+            params = faiss.SearchParameters()
+        return params
+
+    def shard_selector(self, shard, num_shards):
+        # Photo ids are handed out sequentially, so the ids with id % num_shards == shard fit a
+        # small bitmap. It is sized with headroom and only rebuilt once new ids outgrow it.
+        bitmap = self.shard_bitmaps.get((shard, num_shards))
+        if bitmap is None or len(bitmap) * 8 <= self.max_id:
+            members = np.zeros(max(8192, (self.max_id + 1) * 2), dtype=bool)
+            members[shard::num_shards] = True
+            bitmap = np.packbits(members, bitorder='little')
+            self.shard_bitmaps[(shard, num_shards)] = bitmap
+        return faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+    def search(self, features, k=1, shard=None):
+        queries = self.as_matrix(features)
+
+        with self.lock:
+            params = self.search_params()
+
+            sel = None
+            if self.tombstones:
+                if self.tombstone_ids is None:
+                    self.tombstone_ids = np.fromiter(self.tombstones, dtype='int64', count=len(self.tombstones))
+                ids = self.tombstone_ids
+                deleted = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+                sel = faiss.IDSelectorNot(deleted)
+
+            if shard is not None:
+                in_shard = self.shard_selector(*shard)
+                if sel is None:
+                    params.sel = in_shard
+                else:
+                    both = faiss.IDSelectorAnd(sel, in_shard)
+                    params.sel = both
+            elif sel is not None:
+                params.sel = sel
+
+            distances, labels = self.index.search(queries, k, params=params)
+        return distances, labels
+
+    def __len__(self):
+        return self.index.ntotal - len(self.tombstones) - self.stale
@@ -0,0 +1,66 @@
+import bisect
+import hashlib
+import threading
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+def parse_nodes(values):
+    # "id" or "id:weight", e.g. ["0", "1", "2:2"]
+    nodes = {}
+    for value in values:
+        node, _, weight = value.partition(':')
+        nodes[node] = float(weight) if weight else 1.0
+    return nodes
+
+
+class HashRing:
+    def __init__(self, nodes=None, vnodes=160):
+        self.vnodes = vnodes
+        self.weights = {}
+        # (sorted points, owner of each point), replaced as a whole so lookups need no lock
+        self.ring = ([], [])
+        self.lock = threading.Lock()
+        for node, weight in (nodes or {}).items():
+            self.weights[node] = weight
+        self.rebuild()
+
+    def rebuild(self):
+        points = []
+        for node, weight in self.weights.items():
+            for i in range(max(1, int(round(self.vnodes * weight)))):
+                points.append((ring_hash(f"{node}#{i}"), node))
+        points.sort()
+        self.ring = ([point for point, _ in points], [node for _, node in points])
+
+    def add_node(self, node, weight=1.0):
+        with self.lock:
+            self.weights[node] = weight
+            self.rebuild()
+
+    def set_nodes(self, nodes):
+        with self.lock:
+            self.weights = dict(nodes)
+            self.rebuild()
+
+    def remove_node(self, node):
+        with self.lock:
+            if self.weights.pop(node, None) is None:
+                return False
+            self.rebuild()
+            return True
+
+    def get_node(self, key):
+        points, owners = self.ring
+        if not points:
+            return None
+        i = bisect.bisect(points, ring_hash(key))
+        return owners[i % len(points)]
+
+    def nodes(self):
+        return dict(self.weights)
+
+    def __len__(self):
+        return len(self.weights)
@@ -1,222 +1,784 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import os
-import pickle
+import mmap
 import json
+import struct
+import zlib
+import time
+import atexit
+import argparse
+import socket
+import threading
+import multiprocessing
+import contextlib
+import concurrent.futures
+from haystack_codec import FRAMES_MIMETYPE, OCTET_STREAM, frames_length, iter_chunks, iter_frames, photo_mimetype
+from haystack_http import HttpPool
+from werkzeug.serving import make_server
 
 #C:\Users\rushi\Desktop\DS\DS Project\photo_store
 
 app = Flask(__name__)
 
+# On-disk needle: header, payload, footer, then zero padding to an 8 byte boundary
+NEEDLE_HEADER = struct.Struct('<IQBxxxI')  # magic, key, flags, payload size
+NEEDLE_FOOTER = struct.Struct('<II')  # magic, crc32 of the payload
+HEADER_MAGIC = 0x4B545348
+FOOTER_MAGIC = 0x4C444E45
+FLAGS_OFFSET = 12
+NEEDLE_ALIGNMENT = 8
+
+# Index file record, one per written or deleted needle
+INDEX_RECORD = struct.Struct('<QQIBxxx')  # key, needle offset, payload size, flags
+
+def needle_length(size):
+    length = NEEDLE_HEADER.size + size + NEEDLE_FOOTER.size
+    return length + (-length % NEEDLE_ALIGNMENT)
+
 class Needle:
     def __init__(self, photo_id, data, flags=0):
-        self.photo_id = photo_id 
+        self.photo_id = int(photo_id) 
         self.flags = flags  # Default flag is 0 (not deleted) 
         self.data = data  
 
-    def to_dict(self):
-        return {
-            'photo_id': self.photo_id,
-            'flags': self.flags,
-            'data': self.data
-        }
+    def pack(self):
+        size = len(self.data)
+        header = NEEDLE_HEADER.pack(HEADER_MAGIC, self.photo_id, self.flags, size)
+        footer = NEEDLE_FOOTER.pack(FOOTER_MAGIC, zlib.crc32(self.data))
+        padding = b'\0' * (needle_length(size) - NEEDLE_HEADER.size - size - NEEDLE_FOOTER.size)
+        return b''.join([header, self.data, footer, padding])
 
     @classmethod
-    def from_dict(cls, data):
-        return cls(photo_id=data['photo_id'], data=data['data'], flags=data['flags'])
+    def unpack(cls, buffer, offset=0):
+        magic, photo_id, flags, size = NEEDLE_HEADER.unpack_from(buffer, offset)
+        if magic != HEADER_MAGIC:
+            raise ValueError("Corrupt needle header")
+
+        # The payload stays a slice of the volume, it is never decoded
+        start = offset + NEEDLE_HEADER.size
+        data = buffer[start:start + size]
+
+        magic, checksum = NEEDLE_FOOTER.unpack_from(buffer, start + size)
+        if magic != FOOTER_MAGIC or checksum != zlib.crc32(data):
+            raise ValueError(f"Checksum mismatch for photo {photo_id}")
+
+        return cls(photo_id=photo_id, data=data, flags=flags)
+
+class RWLock:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            # Waiting writers go first so a steady stream of reads cannot starve them
+            while self.writing or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+class VolumeLock:
+    def __init__(self):
+        # Serialises appends, deletes and compaction of the volume, file IO happens under it
+        self.mutate = threading.Lock()
+        # Readers share it, mutations take it only to publish index entries, flags or a new file
+        self.rw = RWLock()
+
+class VolumeWriter:
+    def __init__(self, store, phy_volume, max_batch_bytes=4 * 1024 * 1024, max_delay=0.002):
+        self.store = store
+        self.phy_volume = phy_volume
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_bytes = 0
+        self.first_pending_at = 0
+        self.cond = threading.Condition()
+        self.commits = 0
+        self.needles = 0
+
+        self.file = None
+        # Offset a failed group has to be truncated back to before the next one is appended
+        self.torn_at = None
+        self.open()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def open(self):
+        # Called again after compaction has replaced the volume file
+        self.close()
+        self.file = open(self.store.volume_path(self.phy_volume), "ab")
+        self.torn_at = None
+
+    def close(self):
+        file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+    def repair(self):
+        # Closing can fail again on the buffered part of the group, the truncate removes it anyway
+        with contextlib.suppress(OSError):
+            self.close()
+        os.truncate(self.store.volume_path(self.phy_volume), self.torn_at)
+        self.open()
+
+    def submit(self, needle):
+        data = needle.pack()
+        future = concurrent.futures.Future()
+        with self.cond:
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending.append((needle.photo_id, len(needle.data), needle.flags, data, future))
+            self.pending_bytes += len(data)
+            self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                # Let concurrent writes join the group until it is big or old enough
+                deadline = self.first_pending_at + self.max_delay
+                while self.pending_bytes < self.max_batch_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                batch = self.pending
+                self.pending = []
+                self.pending_bytes = 0
+
+            try:
+                self.commit(batch)
+            except Exception as e:
+                # The thread outlives a failed group, every later write to the volume depends on it
+                print(f"Group commit to volume {self.phy_volume} failed: {str(e)}")
+                for _, _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def commit(self, batch):
+        lock = self.store.volume_lock(self.phy_volume)
+        with lock.mutate:
+            if self.torn_at is not None:
+                self.repair()
+            start = self.file.tell()
+            try:
+                self.file.write(b''.join(data for _, _, _, data, _ in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception:
+                # Drop whatever part of the group reached the file, none of it was acknowledged.
+                # If that fails too it is retried before the next group is appended
+                self.torn_at = start
+                with contextlib.suppress(Exception):
+                    self.repair()
+                raise
+
+            # Needles only become readable once they are durable
+            with lock.rw.write():
+                index = self.store.index_data.setdefault(self.phy_volume, {})
+                position = start
+                for photo_id, size, flags, data, _ in batch:
+                    index[photo_id] = (position, size)
+                    self.store.log_index(self.phy_volume, photo_id, position, size, flags)
+                    position += len(data)
+            self.commits += 1
+            self.needles += len(batch)
+
+        for _, _, _, _, future in batch:
+            future.set_result(None)
 
 class HaystackStore:
-    def __init__(self, base_path):
+    def __init__(self, base_path, checkpoint_interval=1.0, group_commit_bytes=4 * 1024 * 1024, group_commit_delay=0.002,
+                 read_only=False, follow_interval=0.05, write_timeout=30.0):
         self.base_path = base_path 
         os.makedirs(self.base_path, exist_ok=True)  
         self.index_data = {}  
+        self.volume_maps = {}
+
+        self.checkpoint_interval = checkpoint_interval
+        self.pending_index = {}
+        self.index_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+
+        # Per volume locks, so appends and compaction of one volume never hold up another
+        self.volume_locks = {}
+        self.volume_locks_lock = threading.Lock()
+        self.map_lock = threading.Lock()
+        self.compacting = {}
+
+        # One group-commit writer per volume, started on its first write
+        self.group_commit_bytes = group_commit_bytes
+        self.group_commit_delay = group_commit_delay
+        self.writers = {}
+        self.writers_lock = threading.Lock()
+        self.write_timeout = write_timeout
+
+        # A read only store shares the volumes of a writer process and follows what it appends
+        self.read_only = read_only
+        self.follow_interval = follow_interval
+        self.volume_ends = {}
+        self.volume_inodes = {}
+
+        if read_only:
+            for phy_volume in self.volume_names():
+                self.refresh(phy_volume)
+            threading.Thread(target=self.follow_loop, daemon=True).start()
+            return
+
+        self.recover()
+
+        threading.Thread(target=self.checkpoint_loop, daemon=True).start()
+        atexit.register(self.checkpoint)
+
+    def volume_path(self, phy_volume):
+        return os.path.join(self.base_path, f"{phy_volume}.dat")
+
+    def index_path(self, phy_volume):
+        return os.path.join(self.base_path, f"{phy_volume}.idx")
+
+    def log_index(self, phy_volume, photo_id, position, size, flags=0):
+        with self.index_lock:
+            if phy_volume not in self.pending_index:
+                self.pending_index[phy_volume] = []
+            self.pending_index[phy_volume].append(INDEX_RECORD.pack(photo_id, position, size, flags))
+
+    def checkpoint(self):
+        with self.checkpoint_lock:
+            with self.index_lock:
+                pending = self.pending_index
+                self.pending_index = {}
+
+            for phy_volume, records in pending.items():
+                with open(self.index_path(phy_volume), "ab") as f:
+                    f.write(b''.join(records))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def rewrite_index(self, phy_volume, index, deleted=()):
+        records = []
+        for photo_id, (position, size) in index.items():
+            flags = 1 if photo_id in deleted else 0
+            records.append(INDEX_RECORD.pack(photo_id, position, size, flags))
+
+        index_path = self.index_path(phy_volume)
+        with open(index_path + ".tmp", "wb") as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self.checkpoint_lock:
+            with self.index_lock:
+                # Queued records still point into the old volume file
+                self.pending_index.pop(phy_volume, None)
+            os.replace(index_path + ".tmp", index_path)
+
+    def checkpoint_loop(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print(f"Error while writing index checkpoint: {str(e)}")
+
+    def load_index(self, phy_volume, volume_size):
+        index = {}
+        end = 0
+        index_path = self.index_path(phy_volume)
+        if not os.path.exists(index_path):
+            return index, end
+
+        with open(index_path, "rb") as f:
+            records = f.read()
+
+        # Drop a record torn by a crash while the index was being appended
+        usable = len(records) - len(records) % INDEX_RECORD.size
+        if usable != len(records) and not self.read_only:
+            os.truncate(index_path, usable)
+
+        for photo_id, position, size, flags in INDEX_RECORD.iter_unpack(memoryview(records)[:usable]):
+            needle_end = position + needle_length(size)
+            if needle_end > volume_size:
+                continue
+            end = max(end, needle_end)
+            if flags == 1:
+                # A checkpointed delete holds even if the flag byte in the needle was lost
+                if index.get(photo_id, (None,))[0] == position:
+                    del index[photo_id]
+                continue
+            index[photo_id] = (position, size)
+
+        return index, end
+
+    def scan_volume(self, phy_volume, position, volume_size):
+        needles = []
+        if position >= volume_size:
+            return needles, position
+
+        with open(self.volume_path(phy_volume), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as volume:
+                while position + NEEDLE_HEADER.size <= volume_size:
+                    try:
+                        needle = Needle.unpack(volume, position)
+                    except (ValueError, struct.error):
+                        break
+                    size = len(needle.data)
+                    needles.append((needle.photo_id, position, size, needle.flags))
+                    position += needle_length(size)
+
+        return needles, position
+
+    def volume_names(self):
+        return [name[:-len(".dat")] for name in sorted(os.listdir(self.base_path)) if name.endswith(".dat")]
+
+    def recover(self):
+        for phy_volume in self.volume_names():
+            self.recover_volume(phy_volume)
+        self.checkpoint()
+
+    def recover_volume(self, phy_volume):
+        start = time.time()
+        volume_size = os.path.getsize(self.volume_path(phy_volume))
+
+        index, end = self.load_index(phy_volume, volume_size)
+
+        # Only needles appended after the last checkpoint have to be read from the volume
+        needles, end_of_needles = self.scan_volume(phy_volume, end, volume_size)
+        for photo_id, position, size, flags in needles:
+            index[photo_id] = (position, size)
+            self.log_index(phy_volume, photo_id, position, size, flags)
+
+        if end_of_needles < volume_size:
+            print(f"Truncating torn needle at offset {end_of_needles} in volume {phy_volume}")
+            os.truncate(self.volume_path(phy_volume), end_of_needles)
+
+        self.index_data[phy_volume] = index
+        print(f"Recovered volume {phy_volume}: {len(index)} needles, {len(needles)} from the volume tail, in {time.time() - start:.2f}s")
+
+    def refresh(self, phy_volume):
+        lock = self.volume_lock(phy_volume)
+        with lock.mutate:
+            try:
+                stat = os.stat(self.volume_path(phy_volume))
+            except FileNotFoundError:
+                return
+
+            end = self.volume_ends.get(phy_volume)
+            if end is None or stat.st_ino != self.volume_inodes.get(phy_volume) or stat.st_size < end:
+                # A volume we have not seen, or one the writer replaced by compacting it
+                index, end = self.load_index(phy_volume, stat.st_size)
+                needles, end = self.scan_volume(phy_volume, end, stat.st_size)
+                for photo_id, position, size, flags in needles:
+                    index[photo_id] = (position, size)
+                with lock.rw.write():
+                    self.index_data[phy_volume] = index
+                    self.volume_maps.pop(phy_volume, None)
+            elif stat.st_size > end:
+                # The scan stops at a needle the writer has not finished, it is picked up next time
+                needles, end = self.scan_volume(phy_volume, end, stat.st_size)
+                if needles:
+                    with lock.rw.write():
+                        index = self.index_data.setdefault(phy_volume, {})
+                        for photo_id, position, size, flags in needles:
+                            index[photo_id] = (position, size)
+
+            self.volume_ends[phy_volume] = end
+            self.volume_inodes[phy_volume] = stat.st_ino
+
+    def follow_loop(self):
+        while True:
+            time.sleep(self.follow_interval)
+            try:
+                for phy_volume in self.volume_names():
+                    self.refresh(phy_volume)
+            except Exception as e:
+                print(f"Error while following volumes: {str(e)}")
+
+    def volume_lock(self, phy_volume):
+        lock = self.volume_locks.get(phy_volume)
+        if lock is None:
+            with self.volume_locks_lock:
+                lock = self.volume_locks.setdefault(phy_volume, VolumeLock())
+        return lock
+
+    def volume_map(self, phy_volume, end):
+        volume_map = self.volume_maps.get(phy_volume)
+
+        # Volumes are append only, so only remap once a needle lies past the mapped length
+        if volume_map is None or len(volume_map) < end:
+            with self.map_lock:
+                volume_map = self.volume_maps.get(phy_volume)
+                if volume_map is None or len(volume_map) < end:
+                    with open(self.volume_path(phy_volume), "rb") as f:
+                        volume_map = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                    self.volume_maps[phy_volume] = volume_map
+
+        return volume_map
+
+    def release_map(self, phy_volume):
+        volume_map = self.volume_maps.pop(phy_volume, None)
+        if volume_map is not None:
+            volume = volume_map.obj
+            volume_map.release()
+            # A streamed read may still hold a slice, the mapping is then freed along with it
+            with contextlib.suppress(BufferError):
+                volume.close()
+
+    def read_needle(self, phy_volume, position, size):
+        end = position + needle_length(size)
+        return Needle.unpack(self.volume_map(phy_volume, end)[position:end])
+
+    def writer(self, phy_volume):
+        if self.read_only:
+            raise RuntimeError("Read only store, writes go to the writer process")
+        writer = self.writers.get(phy_volume)
+        if writer is None:
+            with self.writers_lock:
+                writer = self.writers.get(phy_volume)
+                if writer is None:
+                    writer = VolumeWriter(self, phy_volume, self.group_commit_bytes, self.group_commit_delay)
+                    self.writers[phy_volume] = writer
+        return writer
 
     def add_needle(self, needle: Needle, phy_volume):
         try:
-            volume_path = os.path.join(self.base_path, f"{phy_volume}.pkl")
-
-            with open(volume_path, "ab") as f:
-                position = f.tell()
-                pickle.dump(needle.to_dict(), f)
-                size = f.tell() - position
-
-            if phy_volume not in self.index_data:
-                self.index_data[phy_volume] = {}
-            self.index_data[phy_volume][needle.photo_id] = (position, size)
-
+            # Returns once the needle has been fsynced together with its group
+            self.writer(phy_volume).submit(needle).result(timeout=self.write_timeout)
+        except concurrent.futures.TimeoutError:
+            return f"Error while adding needle: not committed within {self.write_timeout}s"
         except Exception as e:
             return f"Error while adding needle: {str(e)}"
 
+    def writer_stats(self):
+        stats = {}
+        for phy_volume, writer in list(self.writers.items()):
+            stats[phy_volume] = {
+                'commits': writer.commits,
+                'needles': writer.needles,
+                'needles_per_commit': round(writer.needles / writer.commits, 2) if writer.commits else 0
+            }
+        return stats
+
     def read_photo(self, photo_id, phy_volume):
         try:
-            volume_path = os.path.join(self.base_path, f"{phy_volume}.pkl")
+            if self.read_only and photo_id not in self.index_data.get(phy_volume, {}):
+                # Possibly written since the last follow, catch up with the volume once
+                self.refresh(phy_volume)
 
-            if phy_volume in self.index_data and photo_id in self.index_data[phy_volume]:
-                position, size = self.index_data[phy_volume][photo_id]
+            # The index entry and the mapping it points into are read as one consistent pair
+            with self.volume_lock(phy_volume).rw.read():
+                if phy_volume in self.index_data and photo_id in self.index_data[phy_volume]:
+                    position, size = self.index_data[phy_volume][photo_id]
 
-                with open(volume_path, "rb") as f:
-                    f.seek(position)
-                    data_bytes = f.read(size)
-                    needle_dict = pickle.loads(data_bytes)
-                    needle = Needle.from_dict(needle_dict)
+                    needle = self.read_needle(phy_volume, position, size)
 
+                    if needle.photo_id != photo_id:
+                        return f"Error: Needle at offset {position} does not belong to photo {photo_id}"
                     if needle.flags == 1:
                         return f"Error: Photo {photo_id} is deleted."
                     return needle.data 
-            else:
-                return f"Error: Photo {photo_id} not found in volume {phy_volume}"
+                else:
+                    return f"Error: Photo {photo_id} not found in volume {phy_volume}"
         except Exception as e:
             return f"Error while reading photo: {str(e)}"
         
-    def get_adjacent_keys(self, photo_id, num_similar, phy_volume):
-        if phy_volume not in self.index_data:
-            print(f"Volume {phy_volume} not found in index data.")
-            return []
-        
-        keys = list(self.index_data[phy_volume].keys())
-
-        if photo_id not in keys:
-            print(f"Photo ID {photo_id} not found in volume {phy_volume}.")
-            return []
-        
-        result = []
-        index = keys.index(photo_id)
-
-        left_index = index 
-        right_index = index
-        
-        while len(result) < int(num_similar) and (left_index > 0 or right_index < len(keys) - 1):
-            if left_index - 1 >= 0:
-                left_index -= 1
-                result.append(keys[left_index])
-            if right_index + 1 < len(keys):
-                right_index += 1
-                result.append(keys[right_index])
-            
-        return result
-
-    def read_sim_photo(self, photo_id, phy_volume, num_similar):
-        try:
-
-            volume_path = os.path.join(self.base_path, f"{phy_volume}.pkl")
-
-
-            if phy_volume in self.index_data and photo_id in self.index_data[phy_volume]:
-                comibined_data = {'actual': None, 'similar': []}
-
-                adjacent_keys = self.get_adjacent_keys(photo_id, num_similar, phy_volume)
-
-                for key in adjacent_keys:
-                    position, size = self.index_data[phy_volume][key]
-
-                    with open(volume_path, "rb") as f:
-                        f.seek(position)
-                        data_bytes = f.read(size)
-                        needle_dict = pickle.loads(data_bytes)
-                        needle = Needle.from_dict(needle_dict)
-
-                        if needle.flags ==0:
-                            comibined_data['similar'].append(needle.data)
-
-                position, size = self.index_data[phy_volume][photo_id]
-
-                with open(volume_path, "rb") as f:
-                    f.seek(position)
-                    data_bytes = f.read(size)
-                    needle_dict = pickle.loads(data_bytes)
-                    needle = Needle.from_dict(needle_dict)
-
-                    if needle.flags == 1:
-                        return f"Error: Photo {photo_id} is deleted."
+    def read_photos(self, photos):
+        # photos is a list of (photo_id, phy_volume), the data or an error string comes back for each
+        results = [None] * len(photos)
+        by_volume = {}
+        for i, (photo_id, phy_volume) in enumerate(photos):
+            by_volume.setdefault(phy_volume, []).append((photo_id, i))
+
+        for phy_volume, requested in by_volume.items():
+            if self.read_only and any(photo_id not in self.index_data.get(phy_volume, {}) for photo_id, _ in requested):
+                self.refresh(phy_volume)
+
+            with self.volume_lock(phy_volume).rw.read():
+                index = self.index_data.get(phy_volume, {})
+                located = []
+                for photo_id, i in requested:
+                    entry = index.get(photo_id)
+                    if entry is None:
+                        results[i] = f"Error: Photo {photo_id} not found in volume {phy_volume}"
                     else:
-                        comibined_data['actual'] = needle.data
-
-                return comibined_data 
-            else:
-                return f"Error: Photo {photo_id} not found in volume {phy_volume}"
-        except Exception as e:
-            return f"Error while reading photo: {str(e)}"
+                        located.append((entry[0], entry[1], photo_id, i))
+
+                # Read the volume front to back in a single pass over its mapping
+                located.sort()
+                for position, size, photo_id, i in located:
+                    try:
+                        needle = self.read_needle(phy_volume, position, size)
+                    except Exception as e:
+                        results[i] = f"Error while reading photo: {str(e)}"
+                        continue
+
+                    if needle.photo_id != photo_id:
+                        results[i] = f"Error: Needle at offset {position} does not belong to photo {photo_id}"
+                    elif needle.flags == 1:
+                        results[i] = f"Error: Photo {photo_id} is deleted."
+                    else:
+                        results[i] = needle.data
 
+        return results
+        
     def delete_photo(self, photo_id, phy_volume):
+        if self.read_only:
+            return "Error: Read only store, deletes go to the writer process"
         try:
-            if phy_volume in self.index_data and photo_id in self.index_data[phy_volume]:
-                position, size = self.index_data[phy_volume][photo_id]
-                volume_path = os.path.join(self.base_path, f"{phy_volume}.pkl")
+            lock = self.volume_lock(phy_volume)
+            with lock.mutate:
+                if phy_volume in self.index_data and photo_id in self.index_data[phy_volume]:
+                    position, size = self.index_data[phy_volume][photo_id]
+
+                    needle = self.read_needle(phy_volume, position, size)
+                    if needle.photo_id != photo_id:
+                        return f"Error: Needle at offset {position} does not belong to photo {photo_id}"
+
+                    # Deleting only flips the flags byte in the needle header, never under a reader
+                    with open(self.volume_path(phy_volume), "r+b") as f:  
+                        with lock.rw.write():
+                            f.seek(position + FLAGS_OFFSET)
+                            f.write(b'\x01')
+                            f.flush()
+                        # The delete is acknowledged only once the flag is durable
+                        os.fsync(f.fileno())
+                    self.log_index(phy_volume, photo_id, position, size, 1)
+
+                    if phy_volume in self.compacting:
+                        self.compacting[phy_volume].add(photo_id)
+
+                    return f"Photo {photo_id} marked as deleted."
+                else:
+                    return f"Error: Photo {photo_id} not found in volume {phy_volume}"
 
-                with open(volume_path, "r+b") as f:  
-                    f.seek(position)
-                    data_bytes = f.read(size)
-                    needle_dict = pickle.loads(data_bytes)
-                    needle = Needle.from_dict(needle_dict)
-
-                    needle.flags = 1
+        except Exception as e:
+            return f"Error while deleting photo: {str(e)}"
 
-                    f.seek(position)
-                    pickle.dump(needle.to_dict(), f)
+    def compact_volume(self, phy_volume, max_bytes_per_second=None):
+        if self.read_only:
+            return "Error: Read only store, compaction runs in the writer process"
+        lock = self.volume_lock(phy_volume)
+        with lock.mutate:
+            if phy_volume not in self.index_data:
+                return f"Error: Volume {phy_volume} not found"
+            if phy_volume in self.compacting:
+                return f"Error: Volume {phy_volume} is already being compacted"
+            self.compacting[phy_volume] = set()
+            end = os.path.getsize(self.volume_path(phy_volume))
+            entries = sorted(self.index_data[phy_volume].items(), key=lambda item: item[1][0])
 
-                return f"Photo {photo_id} marked as deleted."
-            else:
-                return f"Error: Photo {photo_id} not found in volume {phy_volume}"
+        try:
+            start = time.time()
+            volume_path = self.volume_path(phy_volume)
+            compact_path = volume_path + ".compact"
+            new_index = {}
+            copied = 0
+
+            with open(compact_path, "w+b") as out:
+                # Live needles are copied verbatim while reads and writes carry on
+                for photo_id, (position, size) in entries:
+                    needle = self.read_needle(phy_volume, position, size)
+                    if needle.flags == 1 or needle.photo_id != photo_id:
+                        continue
+
+                    length = needle_length(size)
+                    new_index[photo_id] = (out.tell(), size)
+                    out.write(self.volume_map(phy_volume, position + length)[position:position + length])
+                    copied += length
+
+                    if max_bytes_per_second:
+                        ahead = copied / max_bytes_per_second - (time.time() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+                # Sync the bulk of the copy before writers are held up, only the tail is synced under the lock
+                out.flush()
+                os.fsync(out.fileno())
+
+                with lock.mutate:
+                    # A group that failed to commit must not be copied into the new file
+                    writer = self.writers.get(phy_volume)
+                    if writer is not None and writer.torn_at is not None:
+                        writer.repair()
+
+                    # Catch up with needles appended and photos deleted since the copy started
+                    bytes_before = os.path.getsize(volume_path)
+                    needles, _ = self.scan_volume(phy_volume, end, bytes_before)
+                    for photo_id, position, size, flags in needles:
+                        if flags == 1:
+                            continue
+                        length = needle_length(size)
+                        new_index[photo_id] = (out.tell(), size)
+                        out.write(self.volume_map(phy_volume, position + length)[position:position + length])
+
+                    deleted = self.compacting[phy_volume]
+                    for photo_id in deleted:
+                        if photo_id in new_index:
+                            out.seek(new_index[photo_id][0] + FLAGS_OFFSET)
+                            out.write(b'\x01')
+
+                    out.seek(0, os.SEEK_END)
+                    bytes_after = out.tell()
+                    out.flush()
+                    os.fsync(out.fileno())
+                    out.close()
+
+                    # Without an index file recovery rescans the whole volume, so a crash
+                    # between the two renames can never pair old offsets with the new file.
+                    # The checkpoint lock keeps a concurrent checkpoint from recreating the
+                    # index with records that still point into the old file.
+                    index_path = self.index_path(phy_volume)
+                    replace_error = None
+                    with self.checkpoint_lock:
+                        with lock.rw.write():
+                            # Readers see either the old index with the old file or the new pair
+                            with self.index_lock:
+                                self.pending_index.pop(phy_volume, None)
+                            if os.path.exists(index_path):
+                                os.remove(index_path)
+
+                            # Windows cannot replace a file that is still open or mapped
+                            try:
+                                if writer is not None:
+                                    writer.close()
+                                self.release_map(phy_volume)
+                                os.replace(compact_path, volume_path)
+                                self.index_data[phy_volume] = new_index
+                            except OSError as e:
+                                replace_error = e
+                            finally:
+                                if writer is not None:
+                                    writer.open()
+
+                    if replace_error is not None:
+                        # The old volume stays, it needs its index back. On Windows this happens
+                        # while a streamed read still maps the old file, compaction can be retried.
+                        self.rewrite_index(phy_volume, self.index_data[phy_volume])
+                        raise replace_error
+                    self.rewrite_index(phy_volume, new_index, deleted)
+
+            stats = {
+                'physical_id': phy_volume,
+                'live_needles': len(new_index),
+                'removed_needles': len(entries) + len(needles) - len(new_index),
+                'bytes_before': bytes_before,
+                'bytes_after': bytes_after,
+                'reclaimed_bytes': bytes_before - bytes_after,
+                'seconds': round(time.time() - start, 3)
+            }
+            print(f"Compacted volume {phy_volume}: reclaimed {stats['reclaimed_bytes']} bytes")
+            return stats
 
         except Exception as e:
-            return f"Error while deleting photo: {str(e)}"
-
+            if os.path.exists(volume_path + ".compact"):
+                os.remove(volume_path + ".compact")
+            return f"Error while compacting volume: {str(e)}"
+        finally:
+            with lock.mutate:
+                del self.compacting[phy_volume]
+
+
+# Set in reader workers, the routes that modify volumes are forwarded to the writer process
+writer_url = None
+WRITE_ENDPOINTS = {'upload_photo', 'compact_volume', 'delete_photo', 'write_stats'}
+
+@app.before_request
+def forward_to_writer():
+    if writer_url is None or request.endpoint not in WRITE_ENDPOINTS:
+        return None
+    try:
+        response = http_pool.request(request.method, f"{writer_url}{request.path}", params=request.args,
+                                     data=request.get_data(), headers={'Content-Type': request.content_type or OCTET_STREAM})
+        return Response(response.content, status=response.status_code, content_type=response.headers.get('Content-Type'))
+    except Exception as e:
+        return jsonify({"error": f"Writer process unavailable: {str(e)}"}), 503
 
 @app.route('/get', methods=['GET'])
 def read_photo():
     try:
-        photo_id = request.args.get('key')
+        photo_id = int(request.args.get('key'))
         phy_volume = request.args.get('physical_id')
         logical_volume = request.args.get('logical_id')
 
         photo_data = haystack_store.read_photo(photo_id, phy_volume)
 
-        if "Error" in photo_data:
+        if isinstance(photo_data, str):
             return jsonify({"error": photo_data}), 404
         print("Physical volume: ", phy_volume, "Logical volume: ", logical_volume," ID: ", photo_id)
         
         print("Photo data read successfully")
 
-        return jsonify({'data': photo_data}), 200
+        # Stream straight out of the volume mapping rather than copying the whole needle
+        headers = {'Content-Length': str(len(photo_data))}
+        return Response(iter_chunks(photo_data), status=200, mimetype=photo_mimetype(photo_data), headers=headers)
     
     except Exception as e:
         return jsonify({"error": f"An error occurred while processing the request: {str(e)}"}), 500
     
-@app.route('/get_similar', methods=['GET'])
-def get_similar_photo():
+@app.route('/get_many', methods=['GET'])
+def read_photos():
     try:
-        print("gm")
-        photo_id = request.args.get('key')
-        phy_volume = request.args.get('physical_id')
-        logical_volume = request.args.get('logical_id')
-        num_similar = request.args.get('num_of_similar')
-        print("gm1")
+        keys = [int(key) for key in request.args.get('keys', '').split(',') if key]
+        phy_volumes = [phy for phy in request.args.get('physical_ids', '').split(',') if phy]
 
-        photo_data = haystack_store.read_sim_photo(photo_id, phy_volume, num_similar)
+        if not keys or len(keys) != len(phy_volumes):
+            return jsonify({"error": "keys and physical_ids must be comma separated lists of the same length"}), 400
 
-        if "Error" in photo_data:
-            return jsonify({"error": photo_data}), 404
-        print("Physical volume: ", phy_volume, "Logical volume: ", logical_volume," ID: ", photo_id)
-        
-        print("Photo data read successfully")
+        results = haystack_store.read_photos(list(zip(keys, phy_volumes)))
+        print(f"Read {len(keys)} photos, {sum(isinstance(result, str) for result in results)} missing")
+
+        # Frames follow the order of keys, a photo that cannot be read gets an empty frame
+        frames = [b'' if isinstance(result, str) else result for result in results]
+        headers = {'Content-Length': str(frames_length(frames))}
+        return Response(iter_frames(frames), status=200, mimetype=FRAMES_MIMETYPE, headers=headers)
 
-        return jsonify(photo_data), 200
-    
     except Exception as e:
         return jsonify({"error": f"An error occurred while processing the request: {str(e)}"}), 500
 
 @app.route('/write', methods=['POST'])
 def upload_photo():
     try:
-        data = request.get_json()
-        photo_id = data['photo_id']
+        photo_id = request.args.get('photo_id')
         flags = 0
-        phy_volume = data['physical_id']
-        photo_data = data['photo_data']
-        logical_volume = data['logical_id']
+        phy_volume = request.args.get('physical_id')
+        photo_data = request.get_data()
+        logical_volume = request.args.get('logical_id')
+
+        if not photo_id or not phy_volume or not photo_data:
+            return jsonify({"error": "photo_id, physical_id and photo_data are required"}), 400
         
         needle = Needle(photo_id=photo_id, data=photo_data, flags=flags)
 
-        haystack_store.add_needle(needle, phy_volume)
+        result = haystack_store.add_needle(needle, phy_volume)
+        if isinstance(result, str):
+            return jsonify({"error": result}), 500
         print("Physical volume: ", phy_volume, "Logical volume: ", logical_volume," ID: ", photo_id)
         print("Photo uploaded successfully!")
 
@@ -224,10 +786,32 @@ def upload_photo():
     except Exception as e:
         return jsonify({"error": f"An error occurred while processing the request: {str(e)}"}), 500
 
+@app.route('/compact', methods=['POST'])
+def compact_volume():
+    try:
+        phy_volume = request.args.get('physical_id')
+        max_mb_per_second = request.args.get('max_mb_per_second', type=float)
+        if not phy_volume:
+            return jsonify({"error": "physical_id is required"}), 400
+
+        max_bytes_per_second = max_mb_per_second * 1024 * 1024 if max_mb_per_second else None
+        result = haystack_store.compact_volume(phy_volume, max_bytes_per_second)
+
+        if isinstance(result, str):
+            return jsonify({"error": result}), 404 if "not found" in result else 500
+
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({"error": f"An error occurred while processing the request: {str(e)}"}), 500
+
+@app.route('/write_stats', methods=['GET'])
+def write_stats():
+    return jsonify(haystack_store.writer_stats()), 200
+
 @app.route('/remove', methods=['DELETE'])
 def delete_photo():
     try:
-        photo_id = request.args.get('key')
+        photo_id = int(request.args.get('key'))
         phy_volume = request.args.get('physical_id')
         logical_volume = request.args.get('logical_id')
 
@@ -242,6 +826,77 @@ def delete_photo():
         return jsonify({"error": f"An error occurred while processing the request: {str(e)}", "status": "error"}), 500
 
 
+# werkzeug's dev server closes every connection, including the forwarder's and the caches' pooled
+# ones. Connections are only reused once the store runs under a WSGI server with keep-alive.
+def run_writer(args, port):
+    global haystack_store
+    haystack_store = HaystackStore(base_path=args.base_path, checkpoint_interval=args.checkpoint_interval,
+                                   group_commit_bytes=args.group_commit_bytes, group_commit_delay=args.group_commit_ms / 1000)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+def run_reader(args, listen_fd, port):
+    global haystack_store, writer_url, http_pool
+    haystack_store = HaystackStore(base_path=args.base_path, read_only=True, follow_interval=args.follow_ms / 1000)
+    writer_url = f"http://127.0.0.1:{port}"
+    http_pool = HttpPool()
+    make_server('0.0.0.0', args.port, app, threaded=True, fd=listen_fd).serve_forever()
+
+def serve_prefork(args):
+    # Readers are forked so every worker serves from the listening socket opened here
+    context = multiprocessing.get_context('fork')
+    writer_port = args.writer_port or args.port + 1000
+
+    writer = context.Process(target=run_writer, args=(args, writer_port), daemon=True)
+    writer.start()
+
+    # Let the writer finish recovery, it may truncate torn needles the readers would load
+    deadline = time.time() + 60
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', writer_port), timeout=1).close()
+            break
+        except OSError:
+            if not writer.is_alive() or time.time() > deadline:
+                raise SystemExit("Writer process did not start")
+            time.sleep(0.1)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', args.port))
+    listener.listen(1024)
+    listener.set_inheritable(True)
+
+    readers = [context.Process(target=run_reader, args=(args, listener.fileno(), writer_port), daemon=True) for _ in range(args.workers)]
+    for reader in readers:
+        reader.start()
+    print(f"Serving on port {args.port} with {args.workers} reader workers, writer on port {writer_port}")
+
+    try:
+        for process in [writer] + readers:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in [writer] + readers:
+            process.terminate()
+
 if __name__ == '__main__':
-    haystack_store = HaystackStore(base_path="./photo_store")
-    app.run(host='0.0.0.0', port=7000)
+    parser = argparse.ArgumentParser(description='Run the Flask web server.')
+    parser.add_argument('--port', type=int, default=7000, help='Port to run the web server on')
+    parser.add_argument('--base-path', type=str, default='./photo_store', help='Directory holding the volume and index files')
+    parser.add_argument('--checkpoint-interval', type=float, default=1.0, help='Seconds between index file checkpoints')
+    parser.add_argument('--group-commit-bytes', type=int, default=4 * 1024 * 1024, help='Pending bytes that trigger a volume fsync')
+    parser.add_argument('--group-commit-ms', type=float, default=2, help='Longest a write waits for others to share its fsync')
+    parser.add_argument('--workers', type=int, default=1, help='Reader processes sharing the port, above 1 a separate writer process owns the volumes')
+    parser.add_argument('--writer-port', type=int, default=None, help='Local port of the writer process, defaults to port + 1000')
+    parser.add_argument('--follow-ms', type=float, default=50, help='How often reader workers look for needles appended by the writer')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            parser.error("--workers above 1 needs a platform that can fork")
+        serve_prefork(args)
+    else:
+        haystack_store = HaystackStore(base_path=args.base_path, checkpoint_interval=args.checkpoint_interval,
+                                       group_commit_bytes=args.group_commit_bytes, group_commit_delay=args.group_commit_ms / 1000)
+        app.run(host='0.0.0.0', port=args.port)
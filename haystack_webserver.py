@@ -1,9 +1,14 @@
-from flask import Flask, request, jsonify
-import requests
-import random
-import concurrent.futures
-
-app = Flask(__name__)
+from quart import Quart, Response, request, jsonify
+import httpx
+import asyncio
+import heapq
+import itertools
+import argparse
+from haystack_codec import FRAME_HEADER, FRAMES_MIMETYPE, OCTET_STREAM, STREAM_CHUNK, pack_frames, unpack_frames
+from haystack_http import AsyncHttpPool, DEFAULT_TIMEOUT
+from haystack_ring import parse_nodes
+
+app = Quart(__name__)
 
 DIRECTORY_SERVICE_URLS = [
     "http://localhost:5001",
@@ -13,107 +18,334 @@ DIRECTORY_SERVICE_URLS = [
     "http://localhost:5005"
 ]
 
+# Cache server id on the directories' hash ring -> url
 CACHE_SERVERS_URLS = {
-    0: "http://localhost:6001",
-    1: "http://localhost:6002",
-    2: "http://localhost:6003"
+    '0': "http://localhost:6001",
+    '1': "http://localhost:6002",
+    '2': "http://localhost:6003"
 }
 
+# Ring weight of each cache server, pushed to every directory so they agree on the owners
+CACHE_SERVER_WEIGHTS = {cache_id: 1.0 for cache_id in CACHE_SERVERS_URLS}
+
 MACHINE_URLS = {
     0: "192.168.67.83:7000",
     1: "192.168.67.2:7000"
 }
 
+WRITE_BATCH_SIZE = 64
+
+# Nearest neighbours gathered from every directory shard when placing a photo
+PLACEMENT_K = 8
+
+HTTP_OPTIONS = {'pool_size': 32, 'timeout': DEFAULT_TIMEOUT}
+
+# Keep-alive connections to the directories, caches and stores, shared by every request
+http_pool = None
+
 current_directory_index = 0
 
+# Photo ids are allocated here, before any directory sees the photo, so concurrent writes
+# never share one. It assumes a single webserver process, the counter resumes from the
+# directories on the first write after a start.
+next_photo_id = None
+photo_id_lock = asyncio.Lock()
+
 def get_next_directory_url():
     global current_directory_index
     url = DIRECTORY_SERVICE_URLS[current_directory_index]
     current_directory_index = (current_directory_index + 1) % len(DIRECTORY_SERVICE_URLS)
     return url
 
+@app.before_serving
+async def open_http_pool():
+    global http_pool
+    http_pool = AsyncHttpPool(**HTTP_OPTIONS)
+
+    errors = await push_cache_nodes()
+    for error in errors:
+        print(f"Cache ring not pushed at startup, {error}")
+
+@app.after_serving
+async def close_http_pool():
+    await http_pool.close()
+
+
+async def allocate_photo_ids(count):
+    global next_photo_id
+    async with photo_id_lock:
+        if next_photo_id is None:
+            # Every directory records each photo, so the largest counter is past every used id
+            responses = await asyncio.gather(*[
+                http_pool.get(f"{directory_url}/next_photo_id") for directory_url in DIRECTORY_SERVICE_URLS
+            ], return_exceptions=True)
+            counters = [response.json()['next_photo_id'] for response in responses
+                        if not isinstance(response, Exception) and not response.is_error]
+            if len(counters) != len(DIRECTORY_SERVICE_URLS):
+                raise LookupError("Could not read the photo id counter of every directory")
+            next_photo_id = max(counters)
+
+        photo_id = next_photo_id
+        next_photo_id += count
+        return photo_id
+
+async def push_cache_nodes():
+    # Replaces the whole membership, so pushing again after a failure brings a directory back in line
+    results = await asyncio.gather(*[
+        http_pool.request('PUT', f"{directory_url}/cache_nodes", json={'nodes': CACHE_SERVER_WEIGHTS})
+        for directory_url in DIRECTORY_SERVICE_URLS
+    ], return_exceptions=True)
+
+    errors = []
+    for directory_url, result in zip(DIRECTORY_SERVICE_URLS, results):
+        if isinstance(result, Exception):
+            errors.append(f"{directory_url}: {str(result)}")
+        elif result.is_error:
+            errors.append(f"{directory_url}: HTTP {result.status_code}")
+    return errors
+
+@app.route('/cache_nodes', methods=['GET'])
+async def get_cache_nodes():
+    return jsonify({'nodes': CACHE_SERVER_WEIGHTS, 'urls': CACHE_SERVERS_URLS}), 200
+
+@app.route('/cache_nodes', methods=['POST'])
+async def add_cache_node():
+    data = await request.get_json()
+    if not data or data.get('node') is None or not data.get('url'):
+        return jsonify({"error": "node and url are required"}), 400
+
+    node = str(data['node'])
+    CACHE_SERVERS_URLS[node] = data['url']
+    CACHE_SERVER_WEIGHTS[node] = float(data.get('weight', 1.0))
+
+    errors = await push_cache_nodes()
+    if errors:
+        return jsonify({"error": "Cache ring not updated on every directory, retry the request", "errors": errors}), 500
+    return jsonify({'nodes': CACHE_SERVER_WEIGHTS}), 200
+
+@app.route('/cache_nodes', methods=['DELETE'])
+async def remove_cache_node():
+    node = request.args.get('node')
+    if not node:
+        return jsonify({"error": "node is required"}), 400
+    if node not in CACHE_SERVERS_URLS:
+        return jsonify({"error": "node not found"}), 404
+    if list(CACHE_SERVER_WEIGHTS) == [node]:
+        return jsonify({"error": "cannot remove the last cache server"}), 400
+
+    # The url is kept until the directories stop routing photos to this server
+    CACHE_SERVER_WEIGHTS.pop(node, None)
+    errors = await push_cache_nodes()
+    if errors:
+        return jsonify({"error": "Cache ring not updated on every directory, retry the request", "errors": errors}), 500
+    CACHE_SERVERS_URLS.pop(node, None)
+    return jsonify({'nodes': CACHE_SERVER_WEIGHTS}), 200
+
+@app.route('/http_stats', methods=['GET'])
+async def http_stats():
+    return jsonify(http_pool.stats()), 200
+
+async def fetch_photo(placement):
+    # placement is a directory /read answer, the photo is read through its cache server
+    cache_id = placement.get('cache_id')
+    machine_id = placement.get('machine_id')
 
+    if machine_id is None or machine_id not in MACHINE_URLS.keys():
+        raise ValueError("Machine ID is not valid")
 
-@app.route('/read', methods=['GET'])
-def read_request():
-    photo_id = request.args.get('photo_id')
+    if cache_id is None or str(cache_id) not in CACHE_SERVERS_URLS.keys():
+        raise LookupError("Cache ID not found")
 
-    directory_url = get_next_directory_url()
+    cache_url = CACHE_SERVERS_URLS[str(cache_id)]
+    params = {"key": placement['photo_id'], "logical_id": placement.get('logical_id'), "physical_id": placement.get('physical_id'), "machine_url": MACHINE_URLS[machine_id]}
+    # The body is streamed, callers relay it chunk by chunk and aclose() the response
+    cache_response = await http_pool.stream('GET', f"{cache_url}/read", params=params)
+    if cache_response.is_error:
+        await cache_response.aclose()
+        cache_response.raise_for_status()
+    return cache_response
 
+async def relay_body(response):
     try:
-        response = requests.get(f"{directory_url}/read", params={"photo_id": photo_id})
-        response.raise_for_status()
-        directory_response = response.json()
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
-
-    cache_id = directory_response.get('cache_id')
-    logical_id = directory_response.get('logical_id')
-    physical_id = directory_response.get('physical_id')
-    machine_id = directory_response.get('machine_id')
-
-    if machine_id is None or machine_id not in MACHINE_URLS.keys():
-        return jsonify({"error": "Machine ID is not valid"}), 400
-
-    machine_url = MACHINE_URLS[machine_id]
-
-    if cache_id is not None and cache_id in CACHE_SERVERS_URLS.keys():
-        cache_url = CACHE_SERVERS_URLS[cache_id]
+        async for chunk in response.aiter_raw(STREAM_CHUNK):
+            yield chunk
+    finally:
+        await response.aclose()
+
+class FrameReader:
+    # Reads [u32 length][payload] frames off a streamed response as its bytes arrive
+    def __init__(self, response):
+        self.response = response
+        self.chunks = response.aiter_raw(STREAM_CHUNK)
+        self.buffer = b''
+
+    async def fill(self):
         try:
-            cache_response = requests.get(f"{cache_url}/read", params={"key": photo_id, "logical_id": logical_id, "physical_id": physical_id, "machine_url": machine_url})
-            cache_response.raise_for_status()
-            cache_data = cache_response.json()
-            return jsonify(cache_data['data'])
-        except requests.RequestException as e:
-            return jsonify({"error": str(e)}), 500
-        
-    return jsonify({"error": "Cache ID not found"}), 404
+            self.buffer += await self.chunks.__anext__()
+        except StopAsyncIteration:
+            raise ValueError("Truncated frame")
+
+    async def next_size(self):
+        while len(self.buffer) < FRAME_HEADER.size:
+            await self.fill()
+        (size,) = FRAME_HEADER.unpack_from(self.buffer)
+        self.buffer = self.buffer[FRAME_HEADER.size:]
+        return size
+
+    async def payload(self, size):
+        while size:
+            if not self.buffer:
+                await self.fill()
+            piece = self.buffer[:size]
+            self.buffer = self.buffer[len(piece):]
+            size -= len(piece)
+            yield piece
+
+async def stream_photos(placements):
+    # One streamed /read_many per cache server. Returns the reader each placement's frame
+    # arrives on, in the order of placements, or None where the cache could not be asked
+    groups = {}
+    for i, placement in enumerate(placements):
+        cache_id = str(placement.get('cache_id'))
+        machine_id = placement.get('machine_id')
+        if cache_id in CACHE_SERVERS_URLS and machine_id in MACHINE_URLS:
+            groups.setdefault(cache_id, []).append(i)
+
+    async def read_many(cache_id, indices):
+        params = {
+            'keys': ','.join(str(placements[i]['photo_id']) for i in indices),
+            'physical_ids': ','.join(str(placements[i]['physical_id']) for i in indices),
+            'machine_urls': ','.join(MACHINE_URLS[placements[i]['machine_id']] for i in indices)
+        }
+        response = await http_pool.stream('GET', f"{CACHE_SERVERS_URLS[cache_id]}/read_many", params=params)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return indices, FrameReader(response)
 
-@app.route('/read_similar', methods=['GET'])
-def read_similar_request():
+    readers = [None] * len(placements)
+    results = await asyncio.gather(*[read_many(cache_id, indices) for cache_id, indices in groups.items()], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error while reading photos from cache: {result}")
+            continue
+        indices, reader = result
+        for i in indices:
+            readers[i] = reader
+    return readers
+
+async def close_readers(readers):
+    for reader in {id(reader): reader for reader in readers if reader is not None}.values():
+        await reader.response.aclose()
+
+@app.route('/read', methods=['GET'])
+async def read_request():
     photo_id = request.args.get('photo_id')
-    num_of_similar = request.args.get('num_of_similar')
 
     directory_url = get_next_directory_url()
 
     try:
-        response = requests.get(f"{directory_url}/read", params={"photo_id": photo_id})
+        response = await http_pool.get(f"{directory_url}/read", params={"photo_id": photo_id})
         response.raise_for_status()
         directory_response = response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         return jsonify({"error": str(e)}), 500
 
-    cache_id = directory_response.get('cache_id')
-    logical_id = directory_response.get('logical_id')
-    physical_id = directory_response.get('physical_id')
-    machine_id = directory_response.get('machine_id')
-
-    if machine_id is None or machine_id not in MACHINE_URLS.keys():
-        return jsonify({"error": "Machine ID is not valid"}), 400
+    try:
+        cache_response = await fetch_photo(dict(directory_response, photo_id=photo_id))
+        headers = {}
+        if 'Content-Length' in cache_response.headers:
+            headers['Content-Length'] = cache_response.headers['Content-Length']
+        return Response(relay_body(cache_response), mimetype=cache_response.headers.get('Content-Type', OCTET_STREAM), headers=headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except httpx.HTTPError as e:
+        return jsonify({"error": str(e)}), 500
 
-    machine_url = MACHINE_URLS[machine_id]
+@app.route('/read_similar', methods=['GET'])
+async def read_similar_request():
+    try:
+        photo_id = int(request.args.get('photo_id'))
+        num_of_similar = int(request.args.get('num_of_similar', 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "photo_id and num_of_similar must be integers"}), 400
+    if num_of_similar < 1:
+        return jsonify({"error": "num_of_similar must be positive"}), 400
 
     try:
-        response = requests.get(f"http://{machine_url}/get_similar", params={"key": photo_id, "logical_id": logical_id, "physical_id": physical_id, "machine_url": machine_url, "num_of_similar": num_of_similar})
+        # Nearest neighbours of the photo's embedding across every directory shard
+        nearest = await scatter_search({'photo_id': photo_id}, num_of_similar)
+        photo_ids = [photo_id] + [similar_id for _, similar_id in nearest[0]]
+
+        response = await http_pool.post(f"{get_next_directory_url()}/read_batch", json={'photo_ids': photo_ids})
         response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        placements = response.json()['photos']
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            return jsonify({"error": f"Photo {photo_id} not found"}), 404
+        return jsonify({"error": str(e)}), 500
+    except httpx.HTTPError as e:
         return jsonify({"error": str(e)}), 500
 
+    if not placements or placements[0]['photo_id'] != photo_id:
+        return jsonify({"error": f"Photo {photo_id} not found"}), 404
+
+    readers = await stream_photos(placements)
+    try:
+        first_size = await readers[0].next_size() if readers[0] else 0
+    except (httpx.HTTPError, ValueError):
+        first_size = 0
+    if not first_size:
+        await close_readers(readers)
+        return jsonify({"error": f"Photo {photo_id} could not be read"}), 500
+
+    # The requested photo comes first, similar photos that could not be read are skipped.
+    # Frames are relayed as they arrive, a cache failing part way cuts the response short
+    async def body():
+        try:
+            for i, reader in enumerate(readers):
+                if reader is None:
+                    continue
+                size = first_size if i == 0 else await reader.next_size()
+                if size:
+                    yield FRAME_HEADER.pack(size)
+                    async for piece in reader.payload(size):
+                        yield piece
+        finally:
+            await close_readers(readers)
+
+    return Response(body(), mimetype=FRAMES_MIMETYPE)
+
 
 @app.route('/delete', methods=['DELETE'])
-def delete_request():
+async def delete_request():
     photo_id = request.args.get('photo_id')
-    
-
-    directory_url = get_next_directory_url()
 
-    try:
-        response = requests.delete(f"{directory_url}/delete", params={"photo_id": photo_id})
-        response.raise_for_status()
-        directory_response = response.json()
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    # Every directory searches its own shard of the embeddings, so all of them have to forget the photo
+    responses = await asyncio.gather(*[
+        http_pool.delete(f"{directory_url}/delete", params={"photo_id": photo_id})
+        for directory_url in DIRECTORY_SERVICE_URLS
+    ], return_exceptions=True)
+
+    directory_response = None
+    directory_errors = []
+    for directory_url, response in zip(DIRECTORY_SERVICE_URLS, responses):
+        if isinstance(response, Exception):
+            directory_errors.append(f"{directory_url}: {str(response)}")
+        elif response.status_code == 404:
+            # Already forgotten, e.g. by an earlier attempt of this delete
+            continue
+        elif response.is_error:
+            directory_errors.append(f"{directory_url}: HTTP {response.status_code}")
+        elif directory_response is None:
+            directory_response = response.json()
+
+    if directory_response is None:
+        if directory_errors:
+            return jsonify({"error": "Photo not deleted", "errors": directory_errors}), 500
+        return jsonify({"error": "photo_id not found"}), 404
 
     cache_id = directory_response.get('cache_id')
     logical_id = directory_response.get('logical_id')
@@ -125,301 +357,233 @@ def delete_request():
     for machine_id in machine_ids:
         if machine_id is None or machine_id not in MACHINE_URLS.keys():
             return jsonify({"error": "Machine ID is not valid"}), 400
-        
+
         machine_urls.append(MACHINE_URLS[machine_id])
 
     print(machine_urls)
 
-    if cache_id is not None and cache_id in CACHE_SERVERS_URLS.keys():
-        cache_url = CACHE_SERVERS_URLS[cache_id]
+    if cache_id is not None and str(cache_id) in CACHE_SERVERS_URLS.keys():
+        cache_url = CACHE_SERVERS_URLS[str(cache_id)]
         try:
             physical_ids_str = ','.join(map(str, physical_ids))
             machine_urls_str = ','.join(machine_urls)
-            cache_response = requests.delete(f"{cache_url}/remove", params={"key": photo_id, 'logical_id': logical_id, 'physical_ids': physical_ids_str, 'machine_urls': machine_urls_str})
+            cache_response = await http_pool.delete(f"{cache_url}/remove", params={"key": photo_id, 'logical_id': logical_id, 'physical_ids': physical_ids_str, 'machine_urls': machine_urls_str})
             cache_response.raise_for_status()
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             return jsonify({"error": str(e)}), 500
 
+    if directory_errors:
+        return jsonify({"error": "Photo not deleted from every directory, retry the request", "errors": directory_errors}), 500
     return jsonify({'message': 'Photo deleted successfully'})
 
+async def post_json(url, data):
+    response = await http_pool.post(url, json=data)
+    response.raise_for_status()
+    return response.json()
+
+async def scatter_search(query, k):
+    # query holds either 'features' or an indexed 'photo_id', plus optional ids to 'exclude'.
+    # Every directory searches only the ids in its shard, each shard answers with its own
+    # top k nearest first, so a k-way heap merge gives the global top k for each query
+    num_shards = len(DIRECTORY_SERVICE_URLS)
+    results = await asyncio.gather(*[
+        post_json(f"{directory_url}/search", dict(query, k=k, shard=shard, num_shards=num_shards))
+        for shard, directory_url in enumerate(DIRECTORY_SERVICE_URLS)
+    ])
+
+    merged = []
+    for i in range(len(results[0]['results'])):
+        hits = heapq.merge(*[result['results'][i] for result in results])
+        merged.append([[distance, photo_id] for distance, photo_id in itertools.islice(hits, k)])
+    return merged
+
+async def send_to_store(machine_url, physical_id, photo_data, logical_id, actual_id):
+    payload = {
+        'logical_id': str(logical_id),
+        'physical_id': str(physical_id),
+        'photo_id': str(actual_id)
+    }
+    try:
+        print(f"sending to store {machine_url}")
+        machine_response = await http_pool.post(f"http://{machine_url}/write", params=payload, content=photo_data, headers={'Content-Type': OCTET_STREAM})
+        machine_response.raise_for_status()
+        return {"url": machine_url, "status": "success"}
+    except httpx.HTTPError as e:
+        print(f"Error sending request to {machine_url}: {e}")
+        return {"url": machine_url, "status": "error", "error": str(e)}
+
+async def replicate(updates, writes):
+    # Once placement is known the directory updates and the store writes are independent,
+    # so the photo bytes go to the replicas while the other directories record the mapping
+    update_results, write_results = await asyncio.gather(
+        asyncio.gather(*updates, return_exceptions=True),
+        asyncio.gather(*writes)
+    )
+    update_errors = [str(result) for result in update_results if isinstance(result, Exception)]
+    write_errors = [result for result in write_results if result["status"] == "error"]
+    return update_errors, write_errors, len(write_results)
+
 @app.route('/write', methods=['POST'])
-def write_request():
-    data = request.json
-    if 'photo_data' not in data:
+async def write_request():
+    photo_data = await request.get_data()
+    if not photo_data:
         return jsonify({"error": "photo_data are required"}), 400
 
-    photo_data = data['photo_data']
-
     initial_directory_url = get_next_directory_url()
 
     try:
-        initial_response = requests.post(f"{initial_directory_url}/get_features_along_other_details", json={'photo_data': photo_data})
+        actual_id = await allocate_photo_ids(1)
+        initial_response = await http_pool.post(f"{initial_directory_url}/get_features_along_other_details", params={'photo_id': actual_id}, content=photo_data, headers={'Content-Type': OCTET_STREAM})
         initial_response.raise_for_status()
         initial_result = initial_response.json()
-    except requests.RequestException as e:
+    except (httpx.HTTPError, LookupError) as e:
         return jsonify({"error": str(e)}), 500
 
-    photo_ids = initial_result['list_of_photo_ids']
     features = initial_result['features']
-    actual_id = initial_result['photo_id']
 
     print(f"Photo ID: {actual_id}")
 
-    if len(photo_ids) >= 20:
-        random.shuffle(photo_ids)
-
-        num_directories = len(DIRECTORY_SERVICE_URLS) - 1
-        chunk_size = len(photo_ids) // num_directories
-        chunks = [photo_ids[i * chunk_size: (i + 1) * chunk_size] for i in range(num_directories)]
-
-        if len(photo_ids) % num_directories != 0:
-            chunks[-1].extend(photo_ids[num_directories * chunk_size:])
-
-        combined_result = {
-            'nearest_photos_ids' : [],
-            'features': features, 
-            'photo_id': actual_id,
-        }
-
-        def fetch_nearest(directory_url, chunk_photo_ids):
-            other_data = {'photo_ids': chunk_photo_ids, 'features': features, 'actual_id': actual_id}
-            print(f"Fetching nearest photos from {directory_url}")
-            response = requests.post(f"{directory_url}/compute_nearest", json=other_data)
-            response.raise_for_status()
-            return response.json()
+    other_directory_urls = [url for url in DIRECTORY_SERVICE_URLS if url != initial_directory_url]
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_url = {}
-            for directory_url in DIRECTORY_SERVICE_URLS:
-                if directory_url == initial_directory_url:
-                    continue
-                chunk_photo_ids = chunks.pop(0)
-                future = executor.submit(fetch_nearest, directory_url, chunk_photo_ids)
-                future_to_url[future] = directory_url
-
-            for future in concurrent.futures.as_completed(future_to_url):
-                directory_url = future_to_url[future]
-                try:
-                    result = future.result()
-                    combined_result['nearest_photos_ids'].append(result['nearest_photos_id'])
-                except Exception as e:
-                    return jsonify({"error": str(e)}), 500 
-                
-    else:
-        combined_result = {
-            'nearest_photos_ids': [],
-            'features': features,
-            'photo_id': actual_id
-        }
+    try:
+        nearest = await scatter_search({'features': features, 'exclude': [actual_id]}, PLACEMENT_K)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        combined_result['nearest_photos_ids'] = [None for _ in range(len(photo_ids))]
+    combined_result = {
+        'nearest_photos_ids': [photo_id for _, photo_id in nearest[0]],
+        'features': features,
+        'photo_id': actual_id
+    }
 
     try:
-        final_response = requests.post(f"{initial_directory_url}/write_combined", json=combined_result)
-        final_response.raise_for_status()
-        final_result = final_response.json()
-    except requests.RequestException as e:
+        final_result = await post_json(f"{initial_directory_url}/write_combined", combined_result)
+    except httpx.HTTPError as e:
         return jsonify({"error": str(e)}), 500
 
     physical_ids = final_result['physical_ids']
     logical_id = final_result['logical_id']
     machine_ids = final_result['machine_ids']
 
-    def send_update(direcroty_url):
-        response = requests.post(f"{direcroty_url}/update_volume", json={'photo_id': actual_id, 'logical_id':logical_id, 'features': features})
-        response.raise_for_status()
-        return response.json()
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_url = {}
-        for directory_url in DIRECTORY_SERVICE_URLS:
-            if directory_url == initial_directory_url:
-                continue
-            future = executor.submit(send_update, directory_url)
-            future_to_url[future] = directory_url
-
-        for future in concurrent.futures.as_completed(future_to_url):
-            directory_url = future_to_url[future]
-            try:
-                result = future.result()
-            except Exception as e:
-                return jsonify({"error": str(e)}), 500
-
-    def send_request(machine_url, physical_id):
-        payload = {
-            'photo_data': photo_data,
-            'logical_id': str(logical_id),
-            'physical_id': str(physical_id),
-            'photo_id': str(actual_id)
-        }
-        try:
-            print(f"sending to store {machine_url}")
-            machine_response = requests.post(f"http://{machine_url}/write", json=payload)
-            machine_response.raise_for_status()
-            return {"url": machine_url, "status": "success"}
-        except requests.RequestException as e:
-            print(f"Error sending request to {machine_url}: {e}")
-            return {"url": machine_url, "status": "error", "error": str(e)}
-
-    results = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for physical_id, machine_id in zip(physical_ids, machine_ids):
-            machine_url = MACHINE_URLS[machine_id]
-            if machine_url:
-                futures.append(executor.submit(send_request, machine_url, physical_id))
-
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results.append(result)
-
-    errors = [result for result in results if result["status"] == "error"]
-    if errors or len(results)!=2:
+    updates = [
+        post_json(f"{directory_url}/update_volume", {'photo_id': actual_id, 'logical_id': logical_id, 'features': features})
+        for directory_url in other_directory_urls
+    ]
+
+    writes = []
+    for physical_id, machine_id in zip(physical_ids, machine_ids):
+        machine_url = MACHINE_URLS[machine_id]
+        if machine_url:
+            writes.append(send_to_store(machine_url, physical_id, photo_data, logical_id, actual_id))
+
+    update_errors, errors, num_writes = await replicate(updates, writes)
+    if update_errors:
+        return jsonify({"error": update_errors[0]}), 500
+    if errors or num_writes!=2:
         return jsonify({"errors": errors}), 500
 
     return jsonify({'message': 'Photo written successfully'})
 
 @app.route('/write_batch', methods=['POST'])
-def write_batch_request():
-    data = request.json
-    if 'photo_data' not in data:
+async def write_batch_request():
+    try:
+        photo_data = unpack_frames(await request.get_data())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not photo_data:
         return jsonify({"error": "photo_data are required"}), 400
 
-    photo_data = data['photo_data']
+    photo_ids = []
+
+    # Any number of photos is accepted, placement and replication run one chunk at a time
+    for start in range(0, len(photo_data), WRITE_BATCH_SIZE):
+        result, status = await write_batch_chunk(photo_data[start:start + WRITE_BATCH_SIZE])
+        if status != 200:
+            result['written_photo_ids'] = photo_ids
+            return jsonify(result), status
+        photo_ids.extend(result['photo_ids'])
+
+    return jsonify({'message': 'Photo written successfully', 'photo_ids': photo_ids})
+
+async def write_batch_chunk(photo_data):
+    num_photos = len(photo_data)
 
     initial_directory_url = get_next_directory_url()
 
     try:
-        initial_response = requests.post(f"{initial_directory_url}/get_features_along_other_details_batch", json={'photo_data': photo_data})
+        actual_id = await allocate_photo_ids(num_photos)
+        initial_response = await http_pool.post(f"{initial_directory_url}/get_features_along_other_details_batch", params={'photo_id': actual_id}, content=pack_frames(photo_data), headers={'Content-Type': FRAMES_MIMETYPE})
         initial_response.raise_for_status()
         initial_result = initial_response.json()
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    except (httpx.HTTPError, LookupError) as e:
+        return {"error": str(e)}, 500
 
-    photo_ids = initial_result['list_of_photo_ids']
     features = initial_result['features']
-    actual_id = initial_result['photo_id']
 
-    print(f"Photo ID: {actual_id} to {actual_id + 15}")
+    print(f"Photo ID: {actual_id} to {actual_id + num_photos - 1}")
 
-    random.shuffle(photo_ids)
+    other_directory_urls = [url for url in DIRECTORY_SERVICE_URLS if url != initial_directory_url]
 
-    num_directories = len(DIRECTORY_SERVICE_URLS) - 1
-    chunk_size = len(photo_ids) // num_directories
-    chunks = [photo_ids[i * chunk_size: (i + 1) * chunk_size] for i in range(num_directories)]
-
-    if len(photo_ids) % num_directories != 0:
-        chunks[-1].extend(photo_ids[num_directories * chunk_size:])
+    try:
+        # Photos of the same batch are already indexed on the first directory, leave them out
+        nearest = await scatter_search({'features': features, 'exclude': list(range(actual_id, actual_id + num_photos))}, PLACEMENT_K)
+    except Exception as e:
+        return {"error": str(e)}, 500
 
     combined_result = {
-        'nearest_photos_ids' : [[] for _ in range(16)],
-        'features': features, 
+        'nearest_photos_ids' : [[photo_id for _, photo_id in hits] for hits in nearest],
+        'features': features,
         'photo_id': actual_id,
     }
 
-    def fetch_nearest(directory_url, chunk_photo_ids):
-        other_data = {'photo_ids': chunk_photo_ids, 'features': features, 'actual_id': actual_id}
-        print(f"Fetching nearest photos from {directory_url}")
-        response = requests.post(f"{directory_url}/compute_nearest_batch", json=other_data)
-        response.raise_for_status()
-        return response.json()
-    
-    results = []
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_url = {}
-        for directory_url in DIRECTORY_SERVICE_URLS:
-            if directory_url == initial_directory_url:
-                continue
-            chunk_photo_ids = chunks.pop(0)
-            future = executor.submit(fetch_nearest, directory_url, chunk_photo_ids)
-            future_to_url[future] = directory_url
-
-        for future in concurrent.futures.as_completed(future_to_url):
-            directory_url = future_to_url[future]
-            try:
-                result = future.result()
-                results.append(result)
-            except Exception as e:
-                return jsonify({"error": str(e)}), 500 
-            
-    for result in results:
-        for i in range(16):
-            combined_result['nearest_photos_ids'][i].append(result['nearest_photos_id'][i])
-    
     try:
-        final_response = requests.post(f"{initial_directory_url}/write_combined_batch", json=combined_result)
-        final_response.raise_for_status()
-        final_result = final_response.json()
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+        final_result = await post_json(f"{initial_directory_url}/write_combined_batch", combined_result)
+    except httpx.HTTPError as e:
+        return {"error": str(e)}, 500
 
     physical_ids = final_result['physical_ids']
     logical_id = final_result['logical_id']
     machine_ids = final_result['machine_ids']
 
-    def send_update(direcroty_url):
-        response = requests.post(f"{direcroty_url}/update_volume_batch", json={'photo_id': actual_id, 'logical_id':logical_id, 'features': features})
-        response.raise_for_status()
-        return response.json()
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_url = {}
-        for directory_url in DIRECTORY_SERVICE_URLS:
-            if directory_url == initial_directory_url:
-                continue
-            future = executor.submit(send_update, directory_url)
-            future_to_url[future] = directory_url
-
-        for future in concurrent.futures.as_completed(future_to_url):
-            directory_url = future_to_url[future]
-            try:
-                result = future.result()
-            except Exception as e:
-                return jsonify({"error": str(e)}), 500
-
-    def send_request(machine_url, physical_id, photo_data, logical_id, actual_id):
-        payload = {
-            'photo_data': photo_data,
-            'logical_id': str(logical_id),
-            'physical_id': str(physical_id),
-            'photo_id': str(actual_id)
-        }
-        try:
-            print(f"sending to store {machine_url}")
-            machine_response = requests.post(f"http://{machine_url}/write", json=payload)
-            machine_response.raise_for_status()
-            return {"url": machine_url, "status": "success"}
-        except requests.RequestException as e:
-            print(f"Error sending request to {machine_url}: {e}")
-            return {"url": machine_url, "status": "error", "error": str(e)}
-
-    results = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for i in range(16):
-            photo_data_temp = photo_data[i]
-            logical_id_temp = logical_id[i]
-            physical_id_temp = physical_ids[i]
-            machine_id_temp = machine_ids[i]
-            actual_id_temp = actual_id + i
-
-            for physical_id_f, machine_id_f in zip(physical_id_temp, machine_id_temp):
-                machine_url_f = MACHINE_URLS[machine_id_f]
-                if machine_url_f:
-                    futures.append(executor.submit(send_request, machine_url_f, physical_id_f, photo_data_temp, logical_id_temp, actual_id_temp))
-
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results.append(result)
-
-    errors = [result for result in results if result["status"] == "error"]
-    if errors or len(results)!=2*16:
-        return jsonify({"errors": errors}), 500
+    updates = [
+        post_json(f"{directory_url}/update_volume_batch", {'photo_id': actual_id, 'logical_id': logical_id, 'features': features})
+        for directory_url in other_directory_urls
+    ]
 
-    return jsonify({'message': 'Photo written successfully'})
+    writes = []
+    for i in range(num_photos):
+        for physical_id, machine_id in zip(physical_ids[i], machine_ids[i]):
+            machine_url = MACHINE_URLS[machine_id]
+            if machine_url:
+                writes.append(send_to_store(machine_url, physical_id, photo_data[i], logical_id[i], actual_id + i))
+
+    update_errors, errors, num_writes = await replicate(updates, writes)
+    if update_errors:
+        return {"error": update_errors[0]}, 500
+    if errors or num_writes!=2*num_photos:
+        return {"errors": errors}, 500
+
+    return {'photo_ids': list(range(actual_id, actual_id + num_photos))}, 200
 
 
 
 if __name__ == '__main__':
-    app.run(port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run the Quart web server.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to run the web server on')
+    parser.add_argument('--cache-server', action='append', metavar='ID[:WEIGHT]=URL', help='Cache server on the hash ring, replaces the defaults when given')
+    parser.add_argument('--pool-size', type=int, default=32, help='Keep-alive connections kept across all directories, caches and stores together')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_TIMEOUT[0], help='Seconds to connect to a downstream service')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_TIMEOUT[1], help='Seconds to wait for a downstream response')
+    parser.add_argument('--placement-k', type=int, default=PLACEMENT_K, help='Nearest neighbours each directory shard returns when placing a photo')
+    args = parser.parse_args()
+
+    PLACEMENT_K = args.placement_k
+
+    if args.cache_server:
+        servers = [server.split('=', 1) for server in args.cache_server]
+        CACHE_SERVER_WEIGHTS = parse_nodes([node for node, _ in servers])
+        CACHE_SERVERS_URLS = {node.partition(':')[0]: url for node, url in servers}
+    HTTP_OPTIONS = {'pool_size': args.pool_size, 'timeout': (args.connect_timeout, args.read_timeout)}
+
+    # For production run it under an ASGI server instead, e.g. hypercorn haystack_webserver:app
+    app.run(port=args.port)
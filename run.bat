@@ -22,7 +22,7 @@ for /L %%p in (5001,1,5005) do (
 rem Start cache servers in new tabs
 for /L %%p in (6001,1,6003) do (
     echo Starting cache server on port %%p
-    wt -w 0 nt --title "Cache Server %%p" -- cmd /k python3 "%SCRIPT_DIR%\haystack_cache.py" --port %%p
+    wt -w 0 nt --title "Cache Server %%p" -- cmd /k python3 "%SCRIPT_DIR%\haystack_cache.py" --port %%p --max-bytes 256MB
 )
 
 rem Start the main web server in a new tab